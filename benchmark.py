@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Usage: benchmark.py [options]
+       benchmark.py compare OLD NEW
+
+Benchmark the lemmatizer on synthetic Greek lemma lists and texts. A
+full form lemma list is generated for each of the sizes, together with
+a text with Stephanus numbers, and the main steps of the lemmatizer are
+timed on them. The results are written as JSON, so runs on different
+versions of the script can be compared with the `compare` command.
+
+Commands:
+  compare    Compare the results in the JSON files OLD and NEW, and show
+             how much faster or slower each step has become.
+
+Options:
+  -s, --sizes <list>      Comma separated numbers of forms in the generated
+                          lemma lists. [default: 10000,100000]
+  -w, --words <n>         Number of words in the generated text.
+                          [default: 20000]
+  -a, --ambiguity <rate>  Share of the forms that belong to more than one
+                          lemma. [default: 0.12]
+  -u, --unknown <rate>    Share of the words in the text that are not in the
+                          lemma list. [default: 0.1]
+  -e, --engines <list>    Comma separated lookup engines to benchmark.
+                          [default: compiled,index]
+  -b, --batch             Use batch lookups in the analysis.
+  --scan-sample <n>       Number of words looked up with `find_lemmas`, which
+                          searches the whole lemma list for each word.
+                          [default: 100]
+  -r, --repeat <n>        How many times to run each step. The best time is
+                          reported along with all the runs. [default: 3]
+  --seed <n>              Seed of the random generator, so the generated
+                          files are the same from run to run. [default: 1]
+  -k, --keep <dir>        Keep the generated files and outputs in <dir>
+                          instead of a temporary directory.
+  -o, --output <file>     Where to write the results, `-` meaning stdout.
+                          [default: -]
+  -h, --help              Show this help message and exit.
+"""
+
+from docopt import docopt
+from time import strftime, time
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+from unicodedata import normalize
+
+from itertools import chain
+
+import lemmatizer
+from lemmatizer import (Analyze, Output, LOOKUP_ENGINES, DICTIONARY_SUFFIX, PUNCTUATION,
+                        accent_table, add_line_numbers_to_lines, clean_matches,
+                        compile_dictionary, count_matches, find_lemmas, load_lemmas,
+                        normalize_greek_accents, read_file, split_sections)
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# Version of the layout of the results.
+RESULTS_FORMAT = 1
+
+CONSONANTS = u'βγδζθκλμνξπρστφχψ'
+VOWELS = u'αεηιουω'
+ACCENTED = {u'α': u'ά', u'ε': u'έ', u'η': u'ή', u'ι': u'ί', u'ο': u'ό',
+            u'υ': u'ύ', u'ω': u'ώ'}
+
+# Endings of the generated forms, loosely following the nominal and verbal
+# paradigms. A lemma gets a random selection of them.
+ENDINGS = [
+    u'ος', u'ου', u'ῳ', u'ον', u'ε', u'οι', u'ων', u'οις', u'ους',
+    u'η', u'ης', u'ῃ', u'ην', u'αι', u'αις', u'ας', u'α',
+    u'ω', u'εις', u'ει', u'ομεν', u'ετε', u'ουσι', u'ουσιν', u'ειν',
+    u'ες', u'εν', u'ομην', u'ετο', u'οντο', u'σω', u'σεις',
+    u'σει', u'σα', u'σας', u'σε', u'σαμεν', u'σατε', u'σαν', u'ουσα',
+    u'οντος', u'οντι', u'οντα', u'οντες', u'ουσης', u'ομενος', u'ομενη',
+    u'ομενον', u'μενος', u'μενοι', u'θεις', u'θεντος', u'θη', u'θησαν',
+]
+
+
+def grave(text):
+    """Replace the acute accents of `text` with grave ones, the way an
+    accent is written before another word.
+    """
+    return normalize('NFC', normalize('NFD', text).replace(u'́', u'̀'))
+
+
+def replace_greek_accents(text):
+    """The original implementation of `normalize_greek_accents`, with a
+    separate pass over the text for each replacement. It is kept to check
+    the replacement table of `accent_table` against, and to time the two.
+    """
+
+    # Switch graves to acutes
+    text = text.replace(u'ὰ', u'ά')
+    text = text.replace(u'ὲ', u'έ')
+    text = text.replace(u'ὶ', u'ί')
+    text = text.replace(u'ὸ', u'ό')
+    text = text.replace(u'ὺ', u'ύ')
+    text = text.replace(u'ὴ', u'ή')
+    text = text.replace(u'ὼ', u'ώ')
+
+    text = text.replace(u'ἃ', u'ἅ')
+    text = text.replace(u'ἓ', u'ἕ')
+    text = text.replace(u'ὃ', u'ὅ')
+    text = text.replace(u'ἳ', u'ἵ')
+    text = text.replace(u'ὓ', u'ὕ')
+    text = text.replace(u'ἣ', u'ἥ')
+    text = text.replace(u'ὣ', u'ὥ')
+
+    text = text.replace(u'ἂ', u'ἄ')
+    text = text.replace(u'ἒ', u'ἔ')
+    text = text.replace(u'ὂ', u'ὄ')
+    text = text.replace(u'ἲ', u'ἴ')
+    text = text.replace(u'ὒ', u'ὔ')
+    text = text.replace(u'ἢ', u'ἤ')
+    text = text.replace(u'ὢ', u'ὤ')
+
+    # Make lowercase
+    text = text.lower()
+
+    # Remove punctuation
+    text = text.replace(u',', u'')
+    text = text.replace(u'·', u'')
+
+    return(text)
+
+
+def check_accent_table(punctuation=PUNCTUATION):
+    """Check that the replacements from `accent_table` normalize every
+    character handled by `replace_greek_accents` the same way. Those are
+    the characters of the Greek blocks and of ASCII which it leaves
+    without a grave accent. Punctuation is checked against `punctuation`,
+    which the table is made for. Raise a ValueError on the first
+    character that differs.
+    """
+    pattern, table = accent_table(punctuation)
+    characters = [unichr(code_point) for code_point in
+                  chain(range(0x80), range(0x0370, 0x0400), range(0x1F00, 0x2000))]
+    for char in characters + list(punctuation):
+        if char in punctuation:
+            expected = u''
+        elif char in PUNCTUATION:
+            expected = char
+        else:
+            expected = replace_greek_accents(char)
+            if u'\u0300' in normalize('NFD', expected):
+                continue
+        if pattern.sub(lambda match: table[match.group()], char.lower()) != expected:
+            raise ValueError('Normalization of {!r} does not match the original '
+                             'implementation'.format(char))
+
+
+def generate_stem(generator):
+    """Return a random stem of two or three syllables with an accent."""
+    syllables = [generator.choice(CONSONANTS) + generator.choice(VOWELS)
+                 for _ in range(generator.randint(2, 3))]
+    accented = generator.randrange(len(syllables))
+    syllables[accented] = syllables[accented][0] + ACCENTED[syllables[accented][1]]
+    return u''.join(syllables)
+
+
+def generate_lemma_list(size, ambiguity, generator):
+    """Generate a full form lemma list with about `size` forms, where the
+    share `ambiguity` of the forms is also listed under another lemma.
+
+    Return the lines of the lemma list as a list of strings, and a
+    dictionary mapping each form to its lemmas.
+    """
+    stems = set()
+    lemmas = []
+    forms = {}
+    count = 0
+    while count < size:
+        stem = generate_stem(generator)
+        if stem in stems:
+            continue
+        stems.add(stem)
+        endings = generator.sample(ENDINGS, min(len(ENDINGS), generator.randint(4, 40)))
+        lemma_forms = [stem + ending for ending in endings]
+        lemma = lemma_forms[0]
+        lemmas.append([lemma, lemma_forms])
+        for form in lemma_forms:
+            forms[form] = [lemma]
+        count += len(lemma_forms)
+
+    # List some forms under a second lemma as well
+    ambiguous = generator.sample(sorted(forms), int(len(forms) * ambiguity))
+    for form in ambiguous:
+        lemma, lemma_forms = generator.choice(lemmas)
+        if lemma not in forms[form]:
+            lemma_forms.append(form)
+            forms[form].append(lemma)
+
+    # A trailing space makes the last form of a line count as a form.
+    lines = [u' '.join([lemma] + lemma_forms) + u' ' for lemma, lemma_forms in lemmas]
+
+    return(lines, forms)
+
+
+def generate_text(forms, words, unknown, generator):
+    """Generate a text of about `words` words, drawn from the dictionary
+    `forms` so that a few forms are very frequent and most are rare. The
+    share `unknown` of the words is not in the lemma list. Like a real
+    text, each Stephanus section of 12 lines starts with its number in the
+    `##` format, and the other lines are numbered by counting from it.
+
+    Return the text as a list of lines.
+    """
+    vocabulary = sorted(forms)
+    generator.shuffle(vocabulary)
+    lines = []
+    page, section, line_number = 327, 0, 1
+    count = 0
+    while count < words:
+        line = []
+        for _ in range(generator.randint(6, 12)):
+            if generator.random() < unknown:
+                word = generate_stem(generator) + u'ξ'
+            else:
+                word = vocabulary[int(len(vocabulary) * generator.random() ** 4)]
+            if generator.random() < 0.3:
+                word = grave(word)
+            line.append(word)
+        if generator.random() < 0.2:
+            line[0] = line[0][0].upper() + line[0][1:]
+        if generator.random() < 0.3:
+            line[-1] += generator.choice([u',', u'·', u'.'])
+        count += len(line)
+
+        if line_number == 1:
+            lines.append(u'## {0}.{1}.{2}'.format(page, u'abcde'[section], line_number))
+        lines.append(u' '.join(line) + u' ')
+
+        line_number += 1
+        if line_number > 12:
+            line_number = 1
+            section += 1
+            if section == 5:
+                section = 0
+                page += 1
+
+    return(lines)
+
+
+def generate_lists(forms, generator):
+    """Return the lines of a stopword list with the lemmas of some of the
+    ambiguous forms, and of a disambiguation list resolving half of the
+    other ambiguous forms.
+    """
+    ambiguous = sorted(form for form, lemmas in forms.items() if len(lemmas) > 1)
+    generator.shuffle(ambiguous)
+    stopwords = sorted(set(forms[form][0] for form in ambiguous[:20]))
+    disambiguations = [u'{0} {1}'.format(forms[form][-1], form)
+                       for form in ambiguous[20:20 + len(ambiguous) // 2]]
+    return(stopwords, disambiguations)
+
+
+def write_lines(filename, lines):
+    """Write the list of strings `lines` to `filename` in UTF-8."""
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        f.write(u'\n'.join(lines))
+
+
+def generate_files(directory, size, settings, generator):
+    """Generate a lemma list of `size` forms, a text and stopword and
+    disambiguation lists in `directory`. Return a dictionary with the
+    filenames and some statistics of the generated files.
+    """
+    lemma_lines, forms = generate_lemma_list(size, settings['ambiguity'], generator)
+    text_lines = generate_text(forms, settings['words'], settings['unknown'], generator)
+    stopwords, disambiguations = generate_lists(forms, generator)
+
+    files = {
+        'lemmas': os.path.join(directory, 'lemmalist-{}.txt'.format(size)),
+        'text': os.path.join(directory, 'text-{}.txt'.format(size)),
+        'stopwords': os.path.join(directory, 'stopwords-{}.txt'.format(size)),
+        'disambiguations': os.path.join(directory, 'disambiguations-{}.txt'.format(size)),
+    }
+    write_lines(files['lemmas'], lemma_lines)
+    write_lines(files['text'], text_lines)
+    write_lines(files['stopwords'], stopwords)
+    write_lines(files['disambiguations'], disambiguations)
+
+    statistics = {
+        'forms': len(forms),
+        'lemmas': len(lemma_lines),
+        'ambiguous forms': sum(1 for lemmas in forms.values() if len(lemmas) > 1),
+        'lines': sum(1 for line in text_lines if not line.startswith(u'##')),
+    }
+    return(files, statistics)
+
+
+def measure(function, repeat, setup=None):
+    """Run `function` `repeat` times, calling `setup` before each run, and
+    return the timings and the result of the last run.
+    """
+    runs = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time()
+        result = function()
+        runs.append(round(time() - started, 6))
+    return({'best': min(runs), 'runs': runs}, result)
+
+
+def benchmark_size(directory, size, settings, generator):
+    """Generate the files for `size` forms and time each step of the
+    lemmatizer on them with each engine. Return a list of results.
+    """
+    files, statistics = generate_files(directory, size, settings, generator)
+    repeat = settings['repeat']
+    results = []
+
+    raw_text = read_file(files['text'])
+    timings = {}
+    timings['normalize_greek_accents'], text = measure(
+        lambda: normalize_greek_accents(raw_text), repeat)
+    timings['replace_greek_accents'], _ = measure(
+        lambda: replace_greek_accents(raw_text), repeat)
+    timings['number_lines'], lines = measure(
+        lambda: add_line_numbers_to_lines(text.split('\n')), repeat)
+    timings['split_sections'], _ = measure(lambda: split_sections(lines), repeat)
+
+    tokens = [word for line in lines for word in line[1].split(' ')]
+    statistics['tokens'] = len(tokens)
+    results.append(dict(statistics, engine='none', timings=timings))
+
+    # The original scan of the lemma list, on a sample of the words
+    lemma_string = read_file(files['lemmas'])
+    sample = generator.sample(tokens, min(settings['scan sample'], len(tokens)))
+    timing, _ = measure(lambda: [find_lemmas(word, lemma_string) for word in sample], repeat)
+    timing['calls'] = len(sample)
+    results.append(dict(statistics, engine='scan', timings={'find_lemmas': timing}))
+
+    for engine in settings['engines']:
+        timings = {}
+        compiled = files['lemmas'] + DICTIONARY_SUFFIX
+
+        if engine == 'compiled':
+            timings['compile'], _ = measure(
+                lambda: compile_dictionary(files['lemmas'], compiled), repeat)
+        timings['load'], lemmas = measure(lambda: load_lemmas(files['lemmas'], engine), repeat)
+        timings['engine'], lookup = measure(lambda: LOOKUP_ENGINES[engine](lemmas), repeat)
+        timings['find'], _ = measure(lambda: [lookup.find(word) for word in tokens], repeat)
+        timings['find']['calls'] = len(tokens)
+
+        analysis = Analyze([], lemmas,
+                           disambiguations=files['disambiguations'],
+                           stopwords=files['stopwords'],
+                           engine=engine,
+                           batch=settings['batch'])
+        setup = lambda: analysis.load_text(lines)
+
+        timings['lemmatize_text'], lemmatized = measure(analysis.lemmatize_text, repeat, setup)
+        timings['create_index'], index = measure(
+            lambda: analysis.create_index(clean=False), repeat, setup)
+        matches, disamb_list, nomatch_list = index
+        timings['clean_matches'], _ = measure(lambda: clean_matches(matches), repeat)
+        timings['count_matches'], counted = measure(lambda: count_matches(matches), repeat)
+
+        # The markdown output keeps the plain step names
+        for output_format in Output.formats:
+            suffix = '' if output_format == 'markdown' else '_' + output_format
+            output = Output('file', os.path.join(directory, 'output-{}.txt'.format(size)),
+                            output_format, analysis.engine)
+            timings['output_lemmas' + suffix], _ = measure(
+                lambda: output.output_lemmas(lemmatized, files['text']), repeat)
+            timings['output_index' + suffix], _ = measure(
+                lambda: output.output_index(counted, disamb_list, nomatch_list, files['text']),
+                repeat)
+
+        results.append(dict(statistics, engine=engine, timings=timings))
+        lemmatizer.log.info('Benchmarked the {0} engine with {1} forms.'.format(engine, size))
+
+    return(results)
+
+
+def git_commit():
+    """Return the current git commit of the lemmatizer, if any."""
+    directory = os.path.dirname(os.path.abspath(lemmatizer.__file__))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                             cwd=directory, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode('ascii').strip()
+
+
+def run(settings, directory):
+    """Run the benchmarks described by `settings` with the generated files
+    in `directory`, and return the results as a dictionary.
+    """
+    generator = random.Random(settings['seed'])
+    results = []
+    for size in settings['sizes']:
+        results.extend(benchmark_size(directory, size, settings, generator))
+
+    return({
+        'format': RESULTS_FORMAT,
+        'date': strftime('%Y-%m-%d %H:%M:%S'),
+        'version': lemmatizer.__version__,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': settings,
+        'results': results,
+    })
+
+
+def compare(old, new):
+    """Return a table comparing the best timings of each step in the
+    results `old` and `new`.
+    """
+    def steps(results):
+        table = {}
+        for result in results['results']:
+            for step, timing in result['timings'].items():
+                table[(result['forms'], result['engine'], step)] = timing['best']
+        return table
+
+    old_steps = steps(old)
+    new_steps = steps(new)
+    rows = ['{0:>9} {1:<9} {2:<15} {3:>10} {4:>10} {5:>7}'.format(
+        'forms', 'engine', 'step', 'old (s)', 'new (s)', 'ratio')]
+    for key in sorted(set(old_steps) & set(new_steps)):
+        old_time, new_time = old_steps[key], new_steps[key]
+        ratio = new_time / old_time if old_time else float('inf')
+        rows.append('{0:>9} {1:<9} {2:<15} {3:>10.4f} {4:>10.4f} {5:>6.2f}x'.format(
+            key[0], key[1], key[2], old_time, new_time, ratio))
+
+    missing = len(set(old_steps) ^ set(new_steps))
+    if missing:
+        rows.append('{} steps are only in one of the files.'.format(missing))
+    return('\n'.join(rows))
+
+
+if __name__ == "__main__":
+
+    args = docopt(__doc__)
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+    lemmatizer.quiet = True
+
+    if args['compare']:
+        with open(args['OLD']) as f:
+            old = json.load(f)
+        with open(args['NEW']) as f:
+            new = json.load(f)
+        print(compare(old, new))
+        exit()
+
+    try:
+        settings = {
+            'sizes': [int(size) for size in args['--sizes'].split(',')],
+            'words': int(args['--words']),
+            'ambiguity': float(args['--ambiguity']),
+            'unknown': float(args['--unknown']),
+            'engines': args['--engines'].split(','),
+            'batch': args['--batch'],
+            'scan sample': int(args['--scan-sample']),
+            'repeat': int(args['--repeat']),
+            'seed': int(args['--seed']),
+        }
+    except ValueError:
+        exit('Error: Sizes, words, rates, scan sample, repeat and seed must be numbers.')
+
+    for engine in settings['engines']:
+        if engine not in LOOKUP_ENGINES:
+            exit('Error: Unknown engine `{0}`. Choose among: {1}.'.format(
+                engine, ', '.join(sorted(LOOKUP_ENGINES))))
+
+    try:
+        check_accent_table()
+    except ValueError as e:
+        exit('Error: {}.'.format(e))
+
+    if args['--keep']:
+        directory = args['--keep']
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    else:
+        directory = tempfile.mkdtemp(prefix='lemmatizer-benchmark-')
+
+    try:
+        results = json.dumps(run(settings, directory), indent=2, sort_keys=True)
+    finally:
+        if not args['--keep']:
+            shutil.rmtree(directory)
+
+    if args['--output'] == '-':
+        print(results)
+    else:
+        with open(args['--output'], 'w') as f:
+            f.write(results + '\n')
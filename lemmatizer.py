@@ -1,18 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""Usage: lemmatize.py <command> [options] FILE
+"""Usage: lemmatize.py <command> [options] FILE...
+       lemmatize.py serve [options]
+       lemmatize.py query [options] [LEMMA...]
 
 A script for identifying dictionary forms of words in a text based
 on a full form lemma list. It is also possible to create an index
 locorum based on the lemmatizations.
 
 Arguments:
-  FILE       A plain text file containing the text you want analyzed.
+  FILE       A plain text file containing the text you want analyzed, or `-`
+             to read the text from stdin. Give several files, a directory
+             (meaning all .txt files in it) or a glob pattern to analyze
+             several texts with the same dictionary.
+  LEMMA      A lemma to look up in the index store with the `query` command.
 
 Commands:
   lemmatize  Lemmatize each word in the input file and return the results.
   index      Create an index locorum based on the lemmatization of the input
              file.
+  compile    Compile the lemma list FILE into a binary dictionary, saved as
+             FILE.compiled, for fast loading with the `compiled` engine.
+  serve      Load the dictionary once and serve lemmatizations and indices
+             over HTTP, at the address given by `--server`.
+  client     Lemmatize or index (see `--request`) the input file with a
+             running server.
+  query      Look up where the given lemmas occur in the index store given
+             by `--store`, and list the ambiguous (`--ambiguous`) or unknown
+             (`--unknown`) words in it.
 
 Options:
   -l, --lemmas <file>     A plain text file containing the lemmas to be used for
@@ -22,28 +37,129 @@ Options:
                           the script to recognize. [default: lemmalist.txt]
   -s, --stopwords <file>  A plain text file containing the words that you want
                           the script to skip. [default: stopwords.txt]
+  --stopword-stage <stage>
+                          When to skip stopwords in an index: `before` the
+                          lookup, by the forms of the stopwords found in the
+                          lemma list, or `after` it, by the lemmas of each
+                          word. [default: before]
+  --ambiguous-stopwords   Also skip ambiguous words when all of their
+                          possible lemmas are stopwords.
   -d, --disambiguations <file>
                           A plain text file instructing the script on which of
                           several possibilities should be preferred in need of
                           disambiguation. [default: disambiguations.txt]
   -o, --output <mode>     How do you want it served? Shell, file or both? Output
                           to file is put in a file called `output.txt` in the
-                          working directory. [default: shell]
+                          working directory, or `output-<name of input>.txt`
+                          for each of several input files. [default: shell]
+  -f, --format <format>   Format of the results: `markdown` for reading,
+                          `jsonl` (JSON Lines) or `tsv` (tab separated values)
+                          for further processing. [default: markdown]
+  -m, --merge             With several input files, also create an index of
+                          all of them, where each reference is prefixed by
+                          the name of the input file. It is output to
+                          `output-merged.txt`.
+  -e, --engine <name>     How should the lemma list be searched? `compiled`
+                          uses a compiled copy of the lemma list, which is
+                          updated automatically when the lemma list changes,
+                          `index` builds a lookup table of all forms before the
+                          analysis, `scan` searches the lemma list for every
+                          word. [default: compiled]
+  -b, --batch             Look up each distinct word of the text only once,
+                          before the analysis, and reuse the results for
+                          repeated words.
+  --fallback              Try to find the lemmas of words that are not in the
+                          lemma list: Join words hyphenated across lines,
+                          expand elisions and guess lemmas from the endings
+                          of the words. Guesses are listed among the terms
+                          that need disambiguation, or marked with `?`.
+  -j, --jobs <n>          Number of processes to analyze the text in. The text
+                          is split into chunks of lines that are analyzed in
+                          parallel. [default: 1]
+  --cache <file>          Keep the results of the lookups in this SQLite
+                          database, and reuse them in later runs with the same
+                          lemma list and disambiguations.
+  --cache-size <n>        Maximum number of words in the cache. The words
+                          that have not been used for the longest time are
+                          removed first. [default: 100000]
+  --memory <mb>           Build the index within a memory budget of about this
+                          many megabytes. The input is read line by line, and
+                          the partial index is written to temporary files
+                          whenever it exceeds the budget, to be merged at the
+                          end. Only for the `index` command, and not together
+                          with `--merge` or `--store`.
+  --prefetch <n>          With several input files, read and prepare up to this
+                          many of the next files in the background while the
+                          current one is analyzed, and, with `--output file`,
+                          write the results in the background as well. Not
+                          together with `--jobs`. [default: 0]
+  --stream                Lemmatize the input line by line and output the
+                          results as they are ready, instead of reading the
+                          whole text first. Only for the `lemmatize` command.
+  --server <address>      Address of the server for the `serve` and `client`
+                          commands. [default: localhost:8642]
+  --request <command>     What the `client` command asks the server for,
+                          `lemmatize` or `index`. [default: lemmatize]
+  --store <file>          Keep the index of each input file in this SQLite
+                          database. When a file is indexed again, only the
+                          sections that have changed are analyzed. The
+                          database can be searched with the `query` command.
+  --ambiguous             List the unresolved ambiguous words of the store in
+                          the answer to a query.
+  --unknown               List the unknown words of the store in the answer
+                          to a query.
+  --citation <scheme>     The citation scheme of the line markers in the text:
+                          `stephanus` (e.g. `323.d.9`), `bekker` (e.g.
+                          `1094a1`) or `plain` (e.g. `120` or `3.12`).
+                          [default: stephanus]
+  -p, --punctuation <chars>
+                          Punctuation characters to remove from the text
+                          before the analysis. [default: ,·]
+  --profile <format>      Report the time spent in each stage of the run and
+                          counts of words, lookups, hits, misses, ambiguities,
+                          disambiguations and skipped stopwords to stderr, as
+                          `text` or `json`.
   -l, --log <level>       Set the verbosity of the log. Optional levels are
                           currently just `info` and `debug`. [default: info]
-  -q, --quiet             Do you want the script to run quietly?
+  -q, --quiet             Do you want the script to run quietly? This hides the
+                          progress bar and messages. The progress bar is also
+                          hidden when the output is not a terminal.
   -v, --version           Show script version and exit.
   -h, --help              Show this help message and exit.
 
 For more info, see https://github.com/stenskjaer/lemmatizer.
 """
 
-from docopt import docopt
 from unicodedata import normalize
 from sys import stdout
-from time import strftime
+from array import array
+from itertools import chain
+from contextlib import contextmanager
+from time import strftime, time
 import re
 import logging
+import glob
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+__version__ = '0.0.9'
+
+log = logging.getLogger('lemmatizer')
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    string_types = basestring
+    text_type = unicode
+except NameError:
+    string_types = str
+    text_type = str
 
 
 def recursive_string_find(pattern, string, start=0):
@@ -79,133 +195,1716 @@ def find_lemmas(token, lemma_string):
     return(result_list)
 
 
+class LemmaScan(object):
+    """Lookup engine searching the raw lemma list string for every token.
+
+    This is the original, slow approach, kept for comparison with the
+    indexed engine.
+    """
+
+    def __init__(self, lemma_string):
+        self.lemma_string = lemma_string
+
+    def find(self, token):
+        """Return a list of possible lemmas of `token`."""
+        return find_lemmas(token, self.lemma_string)
+
+    def items(self):
+        """Return (form, lemmas) pairs of all forms of the lemma list."""
+        return LemmaIndex(self.lemma_string).items()
+
+    def forms_of(self, lemmas):
+        """Return a dictionary mapping each form with one of `lemmas` among
+        its lemmas to the tuple of all its lemmas.
+        """
+        return LemmaIndex(self.lemma_string).forms_of(lemmas)
+
+    def collation_key(self, term):
+        """Return the collation key of `term` (see `collation_key`)."""
+        return collation_key(term)
+
+
+class LemmaIndex(object):
+    """Lookup engine based on a dictionary mapping each form in the lemma
+    list to a tuple of its possible lemmas. The dictionary is built once,
+    so each lookup is a single hash lookup instead of a scan of the whole
+    lemma list.
+
+    The results are the same as those of `find_lemmas`: lemmas are
+    returned in the order they occur in the lemma list, and a lemma is
+    repeated if the form is listed more than once.
+    """
+
+    def __init__(self, lemma_string):
+        self.forms = self.build_index(lemma_string)
+        log.debug('Indexed {} forms of the lemma list.'.format(len(self.forms)))
+
+    def build_index(self, lemma_string):
+        """Map every form in `lemma_string` to a tuple of its lemmas.
+
+        `find_lemmas` matches a form only when it is surrounded by spaces,
+        so the first item of a line (the lemma itself) and the last one
+        (unless followed by trailing whitespace) are not registered as
+        forms.
+        """
+        index = {}
+        for line in lemma_string.split('\n'):
+            parts = line.split(' ')
+            lemma = parts[0].strip()
+            previous = None
+            for form in parts[1:-1]:
+                if form == previous:
+                    # The scan is non-overlapping, so a repeated form
+                    # shares its leading space with the previous match and
+                    # is not found.
+                    previous = None
+                    continue
+                if form in index:
+                    index[form].append(lemma)
+                else:
+                    index[form] = [lemma]
+                previous = form
+
+        return(dict((form, tuple(lemmas)) for form, lemmas in index.items()))
+
+    def find(self, token):
+        """Return a list of possible lemmas of `token`."""
+        return list(self.forms.get(token.strip(), ()))
+
+    def items(self):
+        """Return (form, lemmas) pairs of all forms of the lemma list."""
+        return self.forms.items()
+
+    def forms_of(self, lemmas):
+        """Return a dictionary mapping each form with one of `lemmas` among
+        its lemmas to the tuple of all its lemmas.
+        """
+        lemmas = frozenset(lemmas)
+        return(dict((form, form_lemmas) for form, form_lemmas in self.forms.items()
+                    if not lemmas.isdisjoint(form_lemmas)))
+
+    def collation_key(self, term):
+        """Return the collation key of `term` (see `collation_key`)."""
+        return collation_key(term)
+
+
+# Layout of compiled dictionaries: A header, followed by a form table
+# sorted by the UTF-8 encoding of the forms, a lemma table sorted the
+# same way, an array of lemma ids for each form, an array of form ids for
+# each lemma and finally a string pool with all forms and lemmas. Each
+# lemma is followed in the pool by its collation key (see
+# `collation_key`). All integers are unsigned, 32 bit and little endian.
+DICTIONARY_MAGIC = b'LEMDICT3'
+DICTIONARY_SUFFIX = '.compiled'
+DICTIONARY_HEADER = struct.Struct('<8s20sIIII')
+FORM_RECORD = struct.Struct('<IIII')    # form offset, length, ids start, count
+LEMMA_RECORD = struct.Struct('<IIIII')  # lemma offset, length, key length,
+                                        # form ids start, count
+
+# The pyuca collator, loaded by `collation_key` when it is first needed
+collator = None
+
+
+def collation_key(term):
+    """Return the sort key of `term` according to the Unicode Collation
+    Algorithm, which sorts the Greek properly, as a byte string. The
+    weights of the key are packed as big endian 16 bit integers, so the
+    byte strings sort like the keys themselves.
+
+    Uses pyuca, see https://github.com/jtauber/pyuca. Loading its
+    collation table takes a while, so the compiled dictionary stores the
+    keys of all lemmas.
+    """
+    global collator
+    if collator is None:
+        try:
+            from pyuca import Collator
+        except ImportError:
+            exit('Error: To sort the index we need `pyuca` to sort the unicode '
+                 'text properly. Run `pip install pyuca` and try again.')
+        collator = Collator()
+
+    key = collator.sort_key(term)
+
+    return(struct.pack('>{}H'.format(len(key)), *key))
+
+
+def file_digest(filename):
+    """Return the SHA-1 digest of the raw content of a file."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return(digest.digest())
+
+
+def lists_fingerprint(filenames, settings=u''):
+    """Return a SHA-1 hex digest of the content of the files `filenames`
+    and the string `settings`, to tell whether results made with them are
+    still valid.
+    """
+    digest = hashlib.sha1()
+    for filename in filenames:
+        digest.update(file_digest(filename))
+    digest.update(settings.encode('utf-8'))
+
+    return(digest.hexdigest())
+
+
+def compile_dictionary(source, target, digest=None):
+    """Compile the full form lemma list `source` into a binary dictionary
+    and save it as `target`. The digest of the source is stored in the
+    header, so outdated dictionaries can be recognized.
+    """
+    if digest is None:
+        digest = file_digest(source)
+
+    log.info('Compiling {0} into {1}.'.format(source, target))
+    forms = LemmaIndex(read_file(source)).forms
+
+    lemmas = sorted((lemma.encode('utf-8'), lemma)
+                    for lemma in set(chain.from_iterable(forms.values())))
+    lemma_ids = dict((lemma, lemma_id) for lemma_id, (encoded, lemma) in enumerate(lemmas))
+
+    pool = []
+    pool_size = 0
+    lemma_records = []
+    form_records = []
+    id_list = []
+    form_ids = [[] for lemma in lemmas]
+
+    for form_id, (encoded, form) in enumerate(
+            sorted((form.encode('utf-8'), form) for form in forms)):
+        form_records.append(FORM_RECORD.pack(
+            pool_size, len(encoded), len(id_list), len(forms[form])))
+        pool.append(encoded)
+        pool_size += len(encoded)
+        for lemma in forms[form]:
+            id_list.append(lemma_ids[lemma])
+            form_ids[lemma_ids[lemma]].append(form_id)
+
+    form_id_list = []
+    for (encoded, lemma), lemma_form_ids in zip(lemmas, form_ids):
+        key = collation_key(lemma)
+        lemma_records.append(LEMMA_RECORD.pack(
+            pool_size, len(encoded), len(key), len(form_id_list), len(lemma_form_ids)))
+        pool.append(encoded)
+        pool.append(key)
+        pool_size += len(encoded) + len(key)
+        form_id_list.extend(lemma_form_ids)
+
+    header = DICTIONARY_HEADER.pack(
+        DICTIONARY_MAGIC, digest,
+        len(form_records), len(lemma_records), len(id_list), pool_size)
+
+    # Write to a temporary file first, so an interrupted compilation
+    # never leaves a broken dictionary behind.
+    temporary = target + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(header)
+        f.write(b''.join(form_records))
+        f.write(b''.join(lemma_records))
+        for numbers in (id_list, form_id_list):
+            ids = array('I', numbers)
+            if sys.byteorder == 'big':
+                ids.byteswap()
+            ids.tofile(f)
+        f.write(b''.join(pool))
+    os.rename(temporary, target)
+
+    log.debug('Compiled {0} forms of {1} lemmas.'.format(
+        len(form_records), len(lemma_records)))
+
+
+def update_dictionary(source):
+    """Return the filename of the compiled dictionary of the lemma list
+    `source`. The dictionary is (re)compiled if it is missing or if the
+    lemma list has changed since it was compiled.
+    """
+    target = source + DICTIONARY_SUFFIX
+    digest = file_digest(source)
+
+    try:
+        with open(target, 'rb') as f:
+            header = f.read(DICTIONARY_HEADER.size)
+        magic, compiled_digest = DICTIONARY_HEADER.unpack(header)[:2]
+        if magic == DICTIONARY_MAGIC and compiled_digest == digest:
+            log.debug('Compiled dictionary {} is up to date.'.format(target))
+            return(target)
+    except (IOError, struct.error):
+        pass
+
+    inform('Compiling the dictionary, be right back ...')
+    compile_dictionary(source, target, digest)
+
+    return(target)
+
+
+def load_lemmas(filename, engine):
+    """Prepare the lemma list `filename` for the lookup engine `engine`.
+    Return the filename of the compiled dictionary for the `compiled`
+    engine, and the content of the lemma list for the others.
+    """
+    if engine == 'compiled':
+        lemmas = update_dictionary(filename)
+        log.debug('Using compiled dictionary {}'.format(lemmas))
+    else:
+        inform('Reading the dictionary, be right back ...')
+        lemmas = read_file(filename)
+        log.debug('Lemma list read into memory')
+
+    return(lemmas)
+
+
+class CompiledDictionary(object):
+    """Lookup engine based on a compiled dictionary file. The file is
+    memory mapped and forms are found by a binary search in the sorted
+    form table, so nothing but the results of a lookup is loaded into
+    memory.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.digest, self.form_count, self.lemma_count, id_count,
+         pool_size) = DICTIONARY_HEADER.unpack_from(self.data)
+        if magic != DICTIONARY_MAGIC:
+            raise ValueError('{} is not a compiled dictionary.'.format(filename))
+
+        self.form_table = DICTIONARY_HEADER.size
+        self.lemma_table = self.form_table + self.form_count * FORM_RECORD.size
+        self.id_array = self.lemma_table + self.lemma_count * LEMMA_RECORD.size
+        self.form_id_array = self.id_array + id_count * 4
+        self.pool = self.form_id_array + id_count * 4
+
+        log.debug('Opened compiled dictionary {0} with {1} forms.'.format(
+            filename, self.form_count))
+
+    def lemma(self, lemma_id):
+        """Return the lemma with the id `lemma_id`."""
+        offset, length = LEMMA_RECORD.unpack_from(
+            self.data, self.lemma_table + lemma_id * LEMMA_RECORD.size)[:2]
+        start = self.pool + offset
+
+        return(self.data[start:start + length].decode('utf-8'))
+
+    def lemma_record(self, lemma):
+        """Return the id of `lemma`, its start in the file, its length, the
+        length of its collation key and the start and count of its form
+        ids, or None if it is not in the lemma table.
+        """
+        key = lemma.encode('utf-8')
+        low, high = 0, self.lemma_count
+        while low < high:
+            middle = (low + high) // 2
+            offset, length, key_length, ids_start, ids_count = LEMMA_RECORD.unpack_from(
+                self.data, self.lemma_table + middle * LEMMA_RECORD.size)
+            start = self.pool + offset
+            found = self.data[start:start + length]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return(middle, start, length, key_length, ids_start, ids_count)
+
+        return None
+
+    def collation_key(self, term):
+        """Return the collation key of `term` (see `collation_key`), as
+        stored in the dictionary if it is a lemma.
+        """
+        record = self.lemma_record(term)
+        if record is None:
+            return collation_key(term)
+
+        lemma_id, start, length, key_length = record[:4]
+        return(self.data[start + length:start + length + key_length])
+
+    def find(self, token):
+        """Return a list of possible lemmas of `token`."""
+        key = token.strip().encode('utf-8')
+        low, high = 0, self.form_count
+        while low < high:
+            middle = (low + high) // 2
+            offset, length, ids_start, ids_count = FORM_RECORD.unpack_from(
+                self.data, self.form_table + middle * FORM_RECORD.size)
+            start = self.pool + offset
+            form = self.data[start:start + length]
+            if form < key:
+                low = middle + 1
+            elif form > key:
+                high = middle
+            else:
+                lemma_ids = struct.unpack_from(
+                    '<{}I'.format(ids_count), self.data, self.id_array + ids_start * 4)
+                return [self.lemma(lemma_id) for lemma_id in lemma_ids]
+
+        return []
+
+    def items(self):
+        """Yield (form, lemmas) pairs of all forms of the dictionary."""
+        lemmas = [self.lemma(lemma_id) for lemma_id in range(self.lemma_count)]
+        for index in range(self.form_count):
+            offset, length, ids_start, ids_count = FORM_RECORD.unpack_from(
+                self.data, self.form_table + index * FORM_RECORD.size)
+            start = self.pool + offset
+            lemma_ids = struct.unpack_from(
+                '<{}I'.format(ids_count), self.data, self.id_array + ids_start * 4)
+            yield (self.data[start:start + length].decode('utf-8'),
+                   tuple(lemmas[lemma_id] for lemma_id in lemma_ids))
+
+    def fallback_rules(self, max_suffix, rules):
+        """Return the rule table of `Fallback` for the forms of the
+        dictionary (see `build_rules`) as a CompiledRules object. The table
+        is saved next to the dictionary, and only built again when the
+        lemma list or the settings `max_suffix` and `rules` change.
+        """
+        target = self.filename + RULES_SUFFIX
+        try:
+            table = CompiledRules(target)
+            if (table.digest, table.max_suffix, table.rule_limit) == (
+                    self.digest, max_suffix, rules):
+                log.debug('Fallback rules {} are up to date.'.format(target))
+                return table
+            table.data.close()
+        except (EnvironmentError, ValueError, struct.error):
+            pass
+
+        inform('Building the fallback rules, be right back ...')
+        compile_rules(build_rules(self.items(), max_suffix, rules)[0],
+                      target, self.digest, max_suffix, rules)
+
+        return CompiledRules(target)
+
+    def forms_of(self, lemmas):
+        """Return a dictionary mapping each form with one of `lemmas` among
+        its lemmas to the tuple of all its lemmas.
+
+        The forms of each lemma are listed in the dictionary, so just the
+        matching forms are decoded.
+        """
+        form_ids = set()
+        for lemma in lemmas:
+            record = self.lemma_record(lemma)
+            if record is not None:
+                ids_start, ids_count = record[4:]
+                form_ids.update(struct.unpack_from(
+                    '<{}I'.format(ids_count), self.data, self.form_id_array + ids_start * 4))
+
+        forms = {}
+        for form_id in form_ids:
+            offset, length, ids_start, ids_count = FORM_RECORD.unpack_from(
+                self.data, self.form_table + form_id * FORM_RECORD.size)
+            start = self.pool + offset
+            lemma_ids = struct.unpack_from(
+                '<{}I'.format(ids_count), self.data, self.id_array + ids_start * 4)
+            forms[self.data[start:start + length].decode('utf-8')] = tuple(
+                self.lemma(lemma_id) for lemma_id in lemma_ids)
+
+        return(forms)
+
+
+class LookupCache(object):
+    """Persistent cache of the results of the lookup engine `engine`, kept
+    in the SQLite database `filename` between runs. It is used like a
+    lookup engine.
+
+    The cache holds at most `size` words. When it is full, the words that
+    have not been used for the most runs are removed. The cache is emptied
+    when it was made with a different `fingerprint` of the lemma list and
+    disambiguations (see `lists_fingerprint`).
+
+    The cached words are read into memory when the cache is opened, and
+    the new and used words are written back by `save`.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS lookups (token TEXT PRIMARY KEY, lemmas TEXT, used INTEGER);
+    """
+
+    def __init__(self, filename, engine, fingerprint, size=100000):
+        import sqlite3
+
+        self.connection = sqlite3.connect(filename)
+        # Losing the cache in a crash is harmless, so don't wait for the disk
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.executescript(self.schema)
+        self.engine = engine
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        with self.connection:
+            if self.setting('fingerprint') != fingerprint:
+                log.info('The lists have changed, emptying the lookup cache.')
+                self.connection.execute('DELETE FROM lookups')
+                self.connection.execute('DELETE FROM settings')
+                self.set_setting('fingerprint', fingerprint)
+
+        # An empty list of lemmas is stored as NULL
+        self.entries = dict(
+            (token, tuple(lemmas.split(u'\t')) if lemmas is not None else ())
+            for token, lemmas in self.connection.execute(
+                'SELECT token, lemmas FROM lookups ORDER BY used DESC LIMIT ?', (size,)))
+        self.used = set()
+        self.new = {}
+        log.debug('Read {} words from the lookup cache.'.format(len(self.entries)))
+
+    def setting(self, key, default=None):
+        row = self.connection.execute(
+            'SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_setting(self, key, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, u'{}'.format(value)))
+
+    def find(self, token):
+        """Return a list of possible lemmas of `token`."""
+        lemmas = self.entries.get(token)
+        if lemmas is None:
+            self.misses += 1
+            lemmas = self.entries[token] = self.new[token] = tuple(self.engine.find(token))
+        else:
+            self.hits += 1
+            self.used.add(token)
+
+        return list(lemmas)
+
+    def items(self):
+        """Return (form, lemmas) pairs of all forms of the lemma list."""
+        return self.engine.items()
+
+    def forms_of(self, lemmas):
+        """Return a dictionary mapping each form with one of `lemmas` among
+        its lemmas to the tuple of all its lemmas.
+        """
+        return self.engine.forms_of(lemmas)
+
+    def collation_key(self, term):
+        """Return the collation key of `term` (see `collation_key`)."""
+        return self.engine.collation_key(term)
+
+    def save(self):
+        """Write the new words and the use of the cached ones to the
+        database, remove the least recently used words beyond the size of
+        the cache, and update the statistics. Return a message with the
+        statistics.
+        """
+        with self.connection:
+            run = int(self.setting('runs', 0)) + 1
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)',
+                [(token, u'\t'.join(lemmas) if lemmas else None, run)
+                 for token, lemmas in self.new.items()])
+            self.connection.executemany(
+                'UPDATE lookups SET used = ? WHERE token = ?',
+                [(run, token) for token in self.used])
+
+            count = self.connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+            if count > self.size:
+                self.connection.execute(
+                    """DELETE FROM lookups WHERE token IN
+                       (SELECT token FROM lookups ORDER BY used LIMIT ?)""",
+                    (count - self.size,))
+                count = self.size
+
+            hits = int(self.setting('hits', 0)) + self.hits
+            misses = int(self.setting('misses', 0)) + self.misses
+            self.set_setting('runs', run)
+            self.set_setting('hits', hits)
+            self.set_setting('misses', misses)
+
+        self.new = {}
+        self.used = set()
+
+        return('Lookup cache: {0} hits and {1} misses ({2:.1%} hits) in this run, '
+               '{3:.1%} hits in {4} runs, {5} words cached.'.format(
+                   self.hits, self.misses,
+                   self.hits / float(self.hits + self.misses or 1),
+                   hits / float(hits + misses or 1), run, count))
+
+    def close(self):
+        self.connection.close()
+
+
+def build_rules(items, max_suffix, rules):
+    """Return the rule table of `Fallback` for the (form, lemmas) pairs
+    `items`, and the set of all their lemmas. The table maps endings of
+    up to `max_suffix` letters to a tuple of the `rules` most common
+    (ending to remove, ending to add) rules turning a form with that
+    ending into its lemma.
+    """
+    from os.path import commonprefix
+
+    counts = {}
+    lemmas = set()
+    for form, form_lemmas in items:
+        for lemma in form_lemmas:
+            lemmas.add(lemma)
+            stem = len(commonprefix([form, lemma]))
+            if not stem:
+                continue
+            rule = (form[stem:], lemma[stem:])
+            # The rule applies to any word with an ending at least as
+            # long as the part of the form it removes
+            for length in range(max(1, len(rule[0])), min(max_suffix, len(form) - 1) + 1):
+                ending_rules = counts.setdefault(form[-length:], {})
+                ending_rules[rule] = ending_rules.get(rule, 0) + 1
+
+    table = {}
+    for ending, ending_rules in counts.items():
+        # Rules as common as each other are taken in a fixed order, so the
+        # table is the same whatever order the forms come in
+        table[ending] = tuple(sorted(
+            ending_rules, key=lambda rule: (-ending_rules[rule], rule))[:rules])
+
+    return(table, lemmas)
+
+
+class Guess(text_type):
+    """A lemma guessed by `Fallback` for a word that is not in the lemma
+    list. It is used like the lemma itself, and only marked as a guess
+    when it is displayed (see `mark_guesses`).
+    """
+
+
+def mark_guesses(match):
+    """Return the lemmatization `match` of a word with a `?` after each
+    guessed lemma.
+    """
+    return([item + u'?' if isinstance(item, Guess) else item for item in match])
+
+
+def read_guesses(match):
+    """Return the lemmatization `match` of a word, marked by
+    `mark_guesses`, with the guessed lemmas as Guess objects.
+    """
+    return(match[:1] + [Guess(item[:-1]) if item.endswith(u'?') else item
+                        for item in match[1:]])
+
+
+class Fallback(object):
+    """Guesses of the lemmas of words that are not in the lemma list, based
+    on the forms of the lookup engine `engine`.
+
+    Elided words, ending with an apostrophe, are looked up with each of
+    the vowels that may have been elided, also with an aspirated consonant
+    before the apostrophe turned back, so `καθ'` is found as `κατά`.
+
+    Other words are guessed from their endings. Each form of the lemma
+    list gives a rule for turning its last letters into its lemma, e.g.
+    `-ουσιν` into `-ω` for `λύουσιν`. The `rules` most common rules for
+    each ending of up to `max_suffix` letters are kept in a table (see
+    `build_rules`), so a word is guessed with a few lookups of its own
+    endings, longest first. Only guesses that are lemmas in the lemma
+    list are returned.
+
+    The table of a compiled dictionary is saved next to it, so it is only
+    built once. With the other engines it is built in memory.
+    """
+
+    apostrophes = u"'\u2019\u1fbd\u02bc"
+    elided_vowels = u'αειοάέίό'
+    aspirated = {u'θ': u'τ', u'φ': u'π', u'χ': u'κ'}
+
+    def __init__(self, engine, max_suffix=5, rules=3):
+        self.engine = engine
+        self.max_suffix = max_suffix
+        if isinstance(engine, CompiledDictionary):
+            self.rules = engine.fallback_rules(max_suffix, rules)
+            self.lemmas = None
+        else:
+            self.rules, self.lemmas = build_rules(engine.items(), max_suffix, rules)
+        log.debug('Loaded fallback rules for {} endings.'.format(len(self.rules)))
+
+    def is_lemma(self, term):
+        """Return true if `term` is a lemma of the lemma list."""
+        if self.lemmas is None:
+            return self.engine.lemma_record(term) is not None
+
+        return term in self.lemmas
+
+    def find(self, token):
+        """Return a list of guessed lemmas of `token`."""
+        base = token.rstrip(self.apostrophes)
+        if base != token:
+            return self.expand_elision(base)
+
+        for length in range(min(self.max_suffix, len(token) - 1), 0, -1):
+            ending_rules = self.rules.get(token[-length:])
+            if ending_rules is None:
+                continue
+            guesses = []
+            for remove, add in ending_rules:
+                guess = token[:len(token) - len(remove)] + add
+                if guess not in guesses and self.is_lemma(guess):
+                    guesses.append(guess)
+            if guesses:
+                return guesses
+
+        return []
+
+    def expand_elision(self, base):
+        """Return a list of the lemmas of the forms `base` may be an elision
+        of.
+        """
+        bases = [base]
+        if base and base[-1] in self.aspirated:
+            bases.append(base[:-1] + self.aspirated[base[-1]])
+
+        lemmas = []
+        for stem in bases:
+            for vowel in self.elided_vowels:
+                for lemma in self.engine.find(stem + vowel):
+                    if lemma not in lemmas:
+                        lemmas.append(lemma)
+
+        return lemmas
+
+
+# Layout of the rule tables of `Fallback` saved next to compiled
+# dictionaries: A header with the digest of the lemma list and the
+# settings of the table, followed by a table of endings sorted by their
+# UTF-8 encoding, a table of the rules of each ending and finally a
+# string pool with the endings and the parts of the rules. All integers
+# are unsigned, 32 bit and little endian.
+RULES_MAGIC = b'LEMRULE1'
+RULES_SUFFIX = '.rules'
+RULES_HEADER = struct.Struct('<8s20sIIIII')
+ENDING_RECORD = struct.Struct('<IIII')  # ending offset, length, rules start, count
+RULE_RECORD = struct.Struct('<IIII')    # removed offset, length, added offset, length
+
+
+def compile_rules(table, target, digest, max_suffix, rules):
+    """Save the rule table `table` of `Fallback`, made from the lemma list
+    with the digest `digest` with the settings `max_suffix` and `rules`
+    (see `build_rules`), as `target`.
+    """
+    strings = set(table)
+    for ending_rules in table.values():
+        for rule in ending_rules:
+            strings.update(rule)
+
+    pool = []
+    pool_size = 0
+    records = {}
+    for string in strings:
+        encoded = string.encode('utf-8')
+        records[string] = (pool_size, len(encoded))
+        pool.append(encoded)
+        pool_size += len(encoded)
+
+    ending_records = []
+    rule_records = []
+    for encoded, ending in sorted((ending.encode('utf-8'), ending) for ending in table):
+        offset, length = records[ending]
+        ending_records.append(ENDING_RECORD.pack(
+            offset, length, len(rule_records), len(table[ending])))
+        for removed, added in table[ending]:
+            rule_records.append(RULE_RECORD.pack(*(records[removed] + records[added])))
+
+    header = RULES_HEADER.pack(RULES_MAGIC, digest, max_suffix, rules,
+                               len(ending_records), len(rule_records), pool_size)
+
+    temporary = target + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(header)
+        f.write(b''.join(ending_records))
+        f.write(b''.join(rule_records))
+        f.write(b''.join(pool))
+    os.rename(temporary, target)
+
+    log.debug('Compiled fallback rules for {} endings.'.format(len(ending_records)))
+
+
+class CompiledRules(object):
+    """A rule table of `Fallback` saved by `compile_rules`. The file is
+    memory mapped, and the rules of an ending are found by a binary search
+    in the sorted ending table, so it is used like the dictionary of
+    `build_rules` without loading it.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.digest, self.max_suffix, self.rule_limit, self.ending_count,
+         rule_count, pool_size) = RULES_HEADER.unpack_from(self.data)
+        if magic != RULES_MAGIC:
+            raise ValueError('{} is not a table of fallback rules.'.format(filename))
+
+        self.ending_table = RULES_HEADER.size
+        self.rule_table = self.ending_table + self.ending_count * ENDING_RECORD.size
+        self.pool = self.rule_table + rule_count * RULE_RECORD.size
+
+    def __len__(self):
+        return self.ending_count
+
+    def string(self, offset, length):
+        """Return the string at `offset` in the pool."""
+        start = self.pool + offset
+
+        return(self.data[start:start + length].decode('utf-8'))
+
+    def get(self, ending):
+        """Return the tuple of rules of `ending`, or None if there are
+        none.
+        """
+        key = ending.encode('utf-8')
+        low, high = 0, self.ending_count
+        while low < high:
+            middle = (low + high) // 2
+            offset, length, rules_start, rules_count = ENDING_RECORD.unpack_from(
+                self.data, self.ending_table + middle * ENDING_RECORD.size)
+            start = self.pool + offset
+            found = self.data[start:start + length]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                rules = []
+                for index in range(rules_start, rules_start + rules_count):
+                    removed_offset, removed_length, added_offset, added_length = \
+                        RULE_RECORD.unpack_from(
+                            self.data, self.rule_table + index * RULE_RECORD.size)
+                    rules.append((self.string(removed_offset, removed_length),
+                                  self.string(added_offset, added_length)))
+                return tuple(rules)
+
+        return None
+
+
+def join_hyphenated(lines):
+    """Join words hyphenated across line breaks in an iterable of numbered
+    lines. The end of a line ending with `-` is joined with the first word
+    of the next line, and the whole word is kept on the first line.
+    """
+    previous = None
+    for line in lines:
+        if previous is not None:
+            text = previous[1].rstrip()
+            words = line[1].lstrip().split(' ')
+            if text.endswith('-') and text[-2:-1] not in ('', ' ') and words[0]:
+                previous = [previous[0], text[:-1] + words[0]]
+                line = [line[0], ' '.join(words[1:])]
+            yield previous
+        previous = line
+
+    if previous is not None:
+        yield previous
+
+
+LOOKUP_ENGINES = {
+    'compiled': CompiledDictionary,
+    'index': LemmaIndex,
+    'scan': LemmaScan,
+}
+
+
+class Postings(object):
+    """The occurrences of each lemma in a text, for the index.
+
+    Lemmas and line references are interned as integer ids, and the
+    occurrences of each lemma are kept in two arrays, one of line ids and
+    one of counts. Further occurrences of a lemma on the same line only
+    increase the count. The line references are only turned into
+    strings for the output, by `count`.
+    """
+
+    def __init__(self):
+        self.lemmas = []        # Lemma of each lemma id
+        self.lemma_ids = {}
+        self.lines = []         # Line reference of each line id
+        self.line_ids = {}
+        self.postings = []      # Arrays of line ids and counts of each lemma id
+
+    def __len__(self):
+        return len(self.lemmas)
+
+    def __contains__(self, lemma):
+        return lemma in self.lemma_ids
+
+    def line_id(self, reference):
+        """Return the id of the line reference `reference`."""
+        line_id = self.line_ids.get(reference)
+        if line_id is None:
+            line_id = self.line_ids[reference] = len(self.lines)
+            self.lines.append(reference)
+        return line_id
+
+    def add(self, lemma, line_id, count=1):
+        """Register `count` occurrences of `lemma` on the line `line_id`."""
+        lemma_id = self.lemma_ids.get(lemma)
+        if lemma_id is None:
+            lemma_id = self.lemma_ids[lemma] = len(self.lemmas)
+            self.lemmas.append(lemma)
+            self.postings.append((array('I'), array('I')))
+
+        line_ids, counts = self.postings[lemma_id]
+        if line_ids and line_ids[-1] == line_id:
+            counts[-1] += count
+        else:
+            line_ids.append(line_id)
+            counts.append(count)
+
+    def extend(self, other, prefix=''):
+        """Add the occurrences of the Postings object `other`, e.g. of a
+        later part of the text, with `prefix` added to its line references.
+        """
+        references = other.lines
+        if prefix:
+            references = [u'{0}{1}'.format(prefix, reference) for reference in references]
+        line_ids = [self.line_id(reference) for reference in references]
+        for lemma, (other_line_ids, counts) in zip(other.lemmas, other.postings):
+            for line_id, count in zip(other_line_ids, counts):
+                self.add(lemma, line_ids[line_id], count)
+
+    def count(self):
+        """Return a dictionary mapping each lemma to a list of [line
+        reference, count] pairs, in the order the references first occur.
+        """
+        names = self.names()
+        return(dict((lemma, self.references(lemma_id, names))
+                    for lemma_id, lemma in enumerate(self.lemmas)))
+
+    def names(self):
+        """Return the line references of all line ids as strings."""
+        return([u'{0}'.format(reference) for reference in self.lines])
+
+    def references(self, lemma_id, names=None):
+        """Return a list of [line reference, count] pairs of the lemma with
+        the id `lemma_id`, in the order the references first occur. The
+        line references are taken from `names`, as returned by `names`.
+        """
+        if names is None:
+            names = self.names()
+
+        line_ids, counts = self.postings[lemma_id]
+        totals = {}
+        order = []
+        for line_id, count in zip(line_ids, counts):
+            if line_id in totals:
+                totals[line_id] += count
+            else:
+                totals[line_id] = count
+                order.append(line_id)
+
+        return([[names[line_id], totals[line_id]] for line_id in order])
+
+    def size(self):
+        """Return a rough estimate of the memory used by the postings, in
+        bytes.
+        """
+        occurrences = sum(len(line_ids) for line_ids, counts in self.postings)
+        return(len(self.lemmas) * 400 + len(self.lines) * 150 + occurrences * 10)
+
+
+def count_references(line_numbers):
+    """Count the occurrences of each line reference in the list
+    `line_numbers`. Return a list of [line reference, count] pairs, in the
+    order the references first occur.
+    """
+    counts = {}
+    references = []
+    for line in line_numbers:
+        if line in counts:
+            counts[line] += 1
+        else:
+            counts[line] = 1
+            references.append(line)
+
+    return([[line, counts[line]] for line in references])
+
+
+def count_matches(dictionary_of_matches):
+    """Count the line references of each lemma in the Postings object
+    created by the lemmatization function, or in a dictionary mapping each
+    lemma to a list of line references. See `count_references`.
+    """
+    if isinstance(dictionary_of_matches, Postings):
+        return(dictionary_of_matches.count())
+
+    return(dict((lemma, count_references(line_numbers))
+                for lemma, line_numbers in dictionary_of_matches.items()))
+
+
+def format_references(references):
+    """Format a list of [line reference, count] pairs as a string, where
+    the count is added in parentheses to references occurring more than
+    once, e.g. `323.d9, 324.a1 (2)`.
+    """
+    line_refs = []
+    for line, count in references:
+        if count > 1:
+            line_refs.append(u'{0} ({1})'.format(line, count))
+        else:
+            line_refs.append(u'{0}'.format(line))
+
+    return(u', '.join(line_refs))
+
+
 def clean_matches(dictionary_of_matches):
     """Function for counting instances of line references in the
-    dictionary of matches created by the lemmatization function.  This
-    function uses defaultdict to count items in list. See
-    https://docs.python.org/2/library/collections.html#defaultdict-objects
-    """
-    from collections import defaultdict
-
-    matches = {}
-    for lemma in dictionary_of_matches:
-        counter = defaultdict(int)
-        for line in dictionary_of_matches[lemma]:
-            counter[line] += 1
-
-        line_refs = []
-        for item in counter.items():
-            if item[1] > 1:
-                line_refs.append('{0} ({1})'.format(item[0], item[1]))
+    dictionary of matches created by the lemmatization function, and
+    formatting them as strings with `format_references`.
+    """
+    return(dict((lemma, format_references(references))
+                for lemma, references in count_matches(dictionary_of_matches).items()))
+
+
+class ExternalIndex(object):
+    """An index built within a memory budget of about `budget` bytes, for
+    texts whose index does not fit in memory.
+
+    The results of the analysis are added part by part. The words in need
+    of disambiguation and those that could not be found are written to
+    temporary files right away. The postings are collected in memory until
+    they exceed the budget, and are then written to a temporary run file,
+    sorted by the collation keys of the lemmas given by `engine`. At the
+    end the runs are merged, so the lemmas come out in the order of the
+    index with the same references as if the whole index had been built
+    in memory.
+    """
+
+    def __init__(self, engine, budget):
+        from tempfile import TemporaryFile
+
+        self.engine = engine
+        self.budget = budget
+        self.postings = Postings()
+        self.runs = []
+        self.ambiguous_file = TemporaryFile()
+        self.unknown_file = TemporaryFile()
+
+    def add(self, matches, disamb_list, nomatch_list):
+        """Add the results of the analysis of a part of the text, in the
+        order of the text. See `Analyze.index_lines`.
+        """
+        import json
+
+        self.postings.extend(matches)
+        for record in disamb_list:
+            self.ambiguous_file.write(json.dumps(record) + '\n')
+        for record in nomatch_list:
+            self.unknown_file.write(json.dumps(record) + '\n')
+
+        if self.postings.size() > self.budget:
+            self.spill()
+
+    def spill(self):
+        """Write the postings collected so far to a new run file. Each line
+        holds the hex encoded collation key of a lemma, the lemma and its
+        line references and counts, separated by tabs.
+        """
+        from binascii import hexlify
+        from tempfile import TemporaryFile
+
+        # The references are counted lemma by lemma, as they are written
+        entries = sorted(
+            (hexlify(self.engine.collation_key(lemma)).decode('ascii'), lemma, lemma_id)
+            for lemma_id, lemma in enumerate(self.postings.lemmas))
+
+        names = self.postings.names()
+        run = TemporaryFile()
+        for key, lemma, lemma_id in entries:
+            run.write(u'\t'.join([key, lemma] + [
+                u'{0}\t{1}'.format(line, count)
+                for line, count in self.postings.references(lemma_id, names)]).encode('utf-8')
+                + '\n')
+        run.seek(0)
+        self.runs.append(run)
+        self.postings = Postings()
+
+        log.debug('Wrote run {0} of the index with {1} lemmas.'.format(
+            len(self.runs), len(entries)))
+
+    def read_run(self, index):
+        """Yield the entries of the run file `index` as tuples of the key,
+        the lemma, the number of the run and the line references.
+        """
+        for entry in self.runs[index]:
+            fields = entry.rstrip('\n').decode('utf-8').split(u'\t')
+            references = [[line, int(count)] for line, count in zip(fields[2::2], fields[3::2])]
+            yield (fields[0], fields[1], index, references)
+
+    def matches(self):
+        """Merge the runs and yield each lemma with its list of [line
+        reference, count] pairs, in the order of the index.
+        """
+        from heapq import merge
+
+        if self.postings or not self.runs:
+            self.spill()
+        log.debug('Merging {} runs of the index.'.format(len(self.runs)))
+
+        # The entries of a lemma come out in the order of the runs, which
+        # keeps its references in the order of the text
+        lemma = None
+        parts = []
+        for key, run_lemma, index, references in merge(
+                *[self.read_run(index) for index in range(len(self.runs))]):
+            if run_lemma != lemma:
+                if parts:
+                    yield (lemma, self.combine(parts))
+                lemma = run_lemma
+                parts = []
+            parts.append(references)
+        if parts:
+            yield (lemma, self.combine(parts))
+
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+    def combine(self, parts):
+        """Join the lists of [line reference, count] pairs of a lemma in
+        `parts`, from different runs. The counts of references occurring
+        in more than one of them are added up, and the references are kept
+        in the order they first occur.
+        """
+        if len(parts) == 1:
+            return parts[0]
+
+        counts = {}
+        order = []
+        for line, count in chain.from_iterable(parts):
+            if line in counts:
+                counts[line] += count
             else:
-                line_refs.append(item[0])
+                counts[line] = count
+                order.append(line)
+
+        return([[line, counts[line]] for line in order])
+
+    def records(self, f):
+        """Yield the records written to the temporary file `f`."""
+        import json
 
-        matches[lemma] = ', '.join(line_refs)
+        f.seek(0)
+        for line in f:
+            yield json.loads(line)
 
-    return(matches)
+    def ambiguities(self):
+        """Yield the words in need of disambiguation, in the order of the
+        text.
+        """
+        return self.records(self.ambiguous_file)
+
+    def unknown(self):
+        """Yield the words that could not be found, in the order of the
+        text.
+        """
+        return self.records(self.unknown_file)
 
 
 def read_file(filehandle):
     """Open, read and normalize encoding of file and return the content as
-    string
+    string. A filehandle of `-` reads from stdin.
     """
     log.debug('Opening and normalizing {}.'.format(filehandle))
-    with open(filehandle, 'r') as f:
-        content_read = f.read()
-        content_normalized = normalize('NFC', content_read.decode('utf-8'))
+    if filehandle == '-':
+        content_read = sys.stdin.read()
+    else:
+        with open(filehandle, 'r') as f:
+            content_read = f.read()
+    content_normalized = normalize('NFC', content_read.decode('utf-8'))
 
     return(content_normalized)
 
 
-def normalize_greek_accents(text):
+def expand_filenames(patterns):
+    """Return the list of input files given by the list `patterns`. Each
+    item can be a filename, a directory (meaning all `.txt` files in it)
+    or a glob pattern.
+    """
+    filenames = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            filenames.extend(sorted(glob.glob(os.path.join(pattern, '*.txt'))))
+        elif glob.has_magic(pattern):
+            filenames.extend(sorted(glob.glob(pattern)))
+        else:
+            filenames.append(pattern)
+
+    return(filenames)
+
+
+def decode_filename(filename):
+    """Return `filename` as a unicode string, decoded with the encoding of
+    the file system if it is a byte string, or with UTF-8 if that fails,
+    e.g. when the locale is not set.
+    """
+    if not isinstance(filename, bytes):
+        return(filename)
+
+    try:
+        return(filename.decode(sys.getfilesystemencoding() or 'utf-8'))
+    except UnicodeDecodeError:
+        return(filename.decode('utf-8', 'replace'))
+
+
+def output_filename(name):
+    """Return the filename of the output of the work `name` (see
+    `work_names`). Python 2 opens unicode filenames with the encoding of
+    the file system, so there it is encoded like `decode_filename`
+    decodes.
+    """
+    filename = u'output-{}.txt'.format(name)
+    if str is not bytes:
+        return(filename)
+
+    try:
+        return(filename.encode(sys.getfilesystemencoding() or 'utf-8'))
+    except UnicodeEncodeError:
+        return(filename.encode('utf-8'))
+
+
+def work_name(filename):
+    """Return the name of the work in `filename`, i.e. the name of the file
+    without directory and extension, as a unicode string.
+    """
+    if filename == '-':
+        return(u'stdin')
+
+    return(os.path.splitext(os.path.basename(decode_filename(filename)))[0])
+
+
+def work_names(filenames):
+    """Return a dictionary with the name of the work (see `work_name`) in
+    each of `filenames`. When several files have the same name, e.g.
+    `a/x.txt` and `b/x.txt`, the names of their directories are added,
+    separated by `-`, until they differ (`a-x` and `b-x`). Raise a
+    ValueError if a file is given more than once.
+    """
+    for filename in set(filenames):
+        if filenames.count(filename) > 1:
+            raise ValueError('The input file {} is given more than once.'.format(filename))
+
+    names = dict((filename, work_name(filename)) for filename in filenames)
+    depth = dict.fromkeys(filenames, 0)
+    while True:
+        files_by_name = {}
+        for filename, name in names.items():
+            files_by_name.setdefault(name, []).append(filename)
+        clashes = [files for files in files_by_name.values() if len(files) > 1]
+        if not clashes:
+            return(names)
+
+        for files in clashes:
+            extended = False
+            for filename in files:
+                directories = [] if filename == '-' else os.path.dirname(
+                    os.path.abspath(decode_filename(filename))).split(os.sep)
+                if depth[filename] < len(directories):
+                    depth[filename] += 1
+                    names[filename] = u'-'.join(
+                        directories[-depth[filename]:] + [work_name(filename)])
+                    extended = True
+            if not extended:
+                raise ValueError(
+                    'The input file {} is given more than once.'.format(files[0]))
+
+
+def read_lines(filehandle):
+    """Open a file (or stdin, if filehandle is `-`) and yield its lines
+    one at a time, decoded, normalized and without the line break.
+
+    Like splitting the content of `read_file` by line breaks, the file
+    ends with an empty line if the last line ends with a line break.
+    """
+    log.debug('Opening {} for reading line by line.'.format(filehandle))
+    f = sys.stdin if filehandle == '-' else open(filehandle, 'r')
+    try:
+        line = '\n'
+        # Use readline rather than iterating the file, which reads ahead
+        # and would keep lines from stdin waiting.
+        for line in iter(f.readline, ''):
+            yield normalize('NFC', line.decode('utf-8')).rstrip('\n')
+        if line.endswith('\n'):
+            yield u''
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+# Punctuation removed from the text before the analysis
+PUNCTUATION = u',·'
+
+# Replacement tables of `normalize_greek_accents`, by punctuation
+accent_tables = {}
+
+
+def normalize_greek_accents(text, punctuation=PUNCTUATION):
     """Sanitize text for analysis. Includes making turning grave accents
     into acutes, making the whole text lowercase and removing
-    punctuation (.,·)
+    punctuation (by default `,·`). After lowercasing, the accents and
+    punctuation are replaced in a single pass over the text, with the
+    table of `accent_table`.
+    """
+    if punctuation not in accent_tables:
+        accent_tables[punctuation] = accent_table(punctuation)
+    pattern, table = accent_tables[punctuation]
+
+    return(pattern.sub(lambda match: table[match.group()], text.lower()))
+
+
+def accent_table(punctuation):
+    """Return a table of replacements for lowercase text, turning each
+    Greek character with a grave accent into one with an acute and
+    removing the characters in `punctuation`, along with a compiled
+    pattern matching all the characters to be replaced.
+
+    The grave accents are found by the Unicode decomposition of the
+    characters of the Greek and Greek Extended blocks, so combinations
+    with breathings, iota subscripts and diaereses are included.
+    """
+    table = {}
+    for code_point in chain(range(0x0370, 0x0400), range(0x1F00, 0x2000)):
+        char = unichr(code_point).lower()
+        decomposed = normalize('NFD', char)
+        if u'\u0300' in decomposed:
+            table[char] = normalize('NFC', decomposed.replace(u'\u0300', u'\u0301'))
+
+    for char in punctuation:
+        table[char] = u''
+
+    pattern = re.compile(
+        u'[{}]'.format(u''.join(re.escape(char) for char in sorted(table))), re.UNICODE)
+
+    return(pattern, table)
+
+
+class Reference(tuple):
+    """A line reference in a citation scheme, kept as a tuple of integers,
+    the last of which is the number of the line. It is only turned into a
+    string when it is displayed.
+
+    Each subclass implements a citation scheme: `pattern` matches the
+    reference of a line marker and `parse` turns it into a reference,
+    and `__str__` displays it.
+    """
+
+    __slots__ = ()
+    name = 'plain'
+    pattern = re.compile(r'\s*(\d+(?:\.\d+)*)\s*$')
+
+    @classmethod
+    def parse(cls, marker):
+        """Return the reference given by the line marker `marker` (without
+        the leading `##`), or None if it is not a reference of the scheme.
+        """
+        match = cls.pattern.match(marker)
+        if match is None:
+            return None
+
+        return(tuple.__new__(cls, cls.numbers(*match.groups())))
+
+    @classmethod
+    def numbers(cls, numbers):
+        """Return the tuple of integers of the groups of `pattern`."""
+        return(tuple(int(number) for number in numbers.split('.')))
+
+    def __str__(self):
+        return('.'.join(str(number) for number in self))
+
+
+class PlainReference(Reference):
+    """Plain line numbers, e.g. `120`, or numbers of chapters, sections
+    and lines separated by dots, e.g. `3.12` or `1.4.7`.
+    """
+
+    __slots__ = ()
+
+
+class StephanusReference(Reference):
+    """Stephanus references, e.g. `323.d.9` (or `323d9`), displayed as
+    `323.d9`.
     """
 
-    # Switch graves to acutes
-    text = text.replace(u'ὰ', u'ά')
-    text = text.replace(u'ὲ', u'έ')
-    text = text.replace(u'ὶ', u'ί')
-    text = text.replace(u'ὸ', u'ό')
-    text = text.replace(u'ὺ', u'ύ')
-    text = text.replace(u'ὴ', u'ή')
-    text = text.replace(u'ὼ', u'ώ')
+    __slots__ = ()
+    name = 'stephanus'
+    pattern = re.compile(r'\s*(\d+)\s*\.?\s*([a-e])\s*\.?\s*(\d+)\s*$')
+    sections = 'abcde'
 
-    text = text.replace(u'ἃ', u'ἅ')
-    text = text.replace(u'ἓ', u'ἕ')
-    text = text.replace(u'ὃ', u'ὅ')
-    text = text.replace(u'ἳ', u'ἵ')
-    text = text.replace(u'ὓ', u'ὕ')
-    text = text.replace(u'ἣ', u'ἥ')
-    text = text.replace(u'ὣ', u'ὥ')
+    @classmethod
+    def numbers(cls, page, section, line):
+        return((int(page), cls.sections.index(section), int(line)))
 
-    text = text.replace(u'ἂ', u'ἄ')
-    text = text.replace(u'ἒ', u'ἔ')
-    text = text.replace(u'ὂ', u'ὄ')
-    text = text.replace(u'ἲ', u'ἴ')
-    text = text.replace(u'ὒ', u'ὔ')
-    text = text.replace(u'ἢ', u'ἤ')
-    text = text.replace(u'ὢ', u'ὤ')
+    def __str__(self):
+        return('{0}.{1}{2}'.format(self[0], self.sections[self[1]], self[2]))
 
-    # Make lowercase
-    text = text.lower()
 
-    # Remove punctuation
-    text = text.replace(u',', u'')
-    text = text.replace(u'·', u'')
+class BekkerReference(StephanusReference):
+    """Bekker references, e.g. `1094a1` (or `1094.a.1`), displayed as
+    `1094a1`.
+    """
+
+    __slots__ = ()
+    name = 'bekker'
+    pattern = re.compile(r'\s*(\d+)\s*\.?\s*([ab])\s*\.?\s*(\d+)\s*$')
+    sections = 'ab'
 
-    return(text)
+    def __str__(self):
+        return('{0}{1}{2}'.format(self[0], self.sections[self[1]], self[2]))
 
 
-def add_line_numbers_to_lines(list_of_lines):
+CITATION_SCHEMES = dict(
+    (scheme.name, scheme) for scheme in (StephanusReference, BekkerReference, PlainReference))
+
+
+def add_line_numbers_to_lines(list_of_lines, scheme=StephanusReference):
     """Return a list where excessive whitespace is removed and every item
-    starts with a line number of a specific format.
-
-    Assumptions (Should probably get resolved):
-    - That the line number is a stephanus-number (format example: `432.e.3')
-    - That the very first line of the text contains such number
-    """
-    return_list = []
-
-    has_line_numbers = False
-    if list_of_lines[0][:2] == '##':
-        has_line_numbers = True
-
-    if has_line_numbers == True:
-        for line in list_of_lines:
-            if line[:2] == '##':    # Contains a line number
-                current_line_reference = line[2:].strip()
-                reference_prefix = current_line_reference.rsplit('.', 1)[0]
-                line_number = int(current_line_reference.rsplit('.', 1)[1])
-                line_index = 0
-                continue            # Move on to next line
+    starts with a line reference in the citation scheme `scheme` (one of
+    `CITATION_SCHEMES`). See `number_lines`.
+    """
+    return(list(number_lines(list_of_lines, scheme)))
+
+
+def number_lines(lines, scheme=StephanusReference):
+    """Generator version of `add_line_numbers_to_lines`. Yield each line
+    of the iterable `lines` with its line reference as soon as it is read.
+
+    A line starting with `##` is a line marker, giving the reference of
+    the next line in the citation scheme `scheme`. The following lines are
+    numbered on from it until the next marker. Lines before the first
+    marker are numbered from 1. Markers that are not references of the
+    scheme are skipped with a warning.
+    """
+    # The reference of each line is built from the parts of the marker
+    # before the line number, which are only parsed once
+    new = tuple.__new__
+    reference_type, prefix, line_number = PlainReference, (), 1
+
+    for number, line in enumerate(lines, 1):
+        if line[:2] == '##':    # Contains a line number
+            marker = scheme.parse(line[2:])
+            if marker is None:
+                log.warning('Skipping the line marker `{0}` on line {1}, which is not a '
+                            '{2} reference.'.format(line.encode('utf-8'), number, scheme.name))
             else:
-                line_number += line_index
-                current_line_reference = reference_prefix + str(line_number)
-                line_index += 1
+                reference_type, prefix, line_number = scheme, marker[:-1], marker[-1]
+            continue            # Move on to next line
 
+        yield [new(reference_type, prefix + (line_number,)), line.strip()]
+        line_number += 1
 
-            return_list.append([current_line_reference, line.strip()])
-    else:
-        return_list = [[val + 1, line] for val, line in enumerate(list_of_lines)]
 
-    return(return_list)
+def prepare_text(filename, punctuation=PUNCTUATION, profile=None, scheme=StephanusReference):
+    """Read the text `filename`, normalize it and split it into lines
+    numbered in the citation scheme `scheme`, ready for
+    `Analyze.load_text`. The time spent on each step is recorded in
+    `profile`, if given.
+    """
+    profile = profile or Profile()
+
+    with profile.stage('read file'):
+        content = read_file(filename)
+
+    with profile.stage('normalization'):
+        content = normalize_greek_accents(content, punctuation)
+    log.debug('Normalized accents of the loaded text.')
+
+    content_list = content.split("\n")
+    log.debug('Text has been split into list of lines.')
+
+    with profile.stage('line numbering'):
+        content_list = add_line_numbers_to_lines(content_list, scheme)
+    log.debug('Line numbers added to list of lines.')
+
+    return(content_list)
+
+
+class Disambiguations(object):
+    """Lookup table of the preferred lemmas of ambiguous forms.
+
+    Each line of a disambiguation list contains a lemma followed by the
+    forms that should be identified with it. A form can be given a
+    context rule by adding `[prev=<word>]` or `[next=<word>]` to it, e.g.
+    `ἐάν ἄν[prev=εἰ]`. Then it is only identified with the lemma when the
+    previous (or next) word on the line is <word>. Context rules take
+    precedence over plain forms, and if a form is listed more than once,
+    the first lemma is used.
+    """
+
+    context_rule = re.compile(r'^(.+)\[(prev|next)=(.+)\]$', re.UNICODE)
+
+    def __init__(self, text):
+        self.forms = {}
+        self.previous_rules = {}
+        self.next_rules = {}
+
+        for line in text.split('\n'):
+            items = line.split()
+            for form in items[1:]:
+                rule = self.context_rule.match(form)
+                if rule is None:
+                    self.forms.setdefault(form, items[0])
+                elif rule.group(2) == 'prev':
+                    self.previous_rules.setdefault((rule.group(3), rule.group(1)), items[0])
+                else:
+                    self.next_rules.setdefault((rule.group(1), rule.group(3)), items[0])
+
+        log.debug('Loaded {0} disambiguations and {1} context rules.'.format(
+            len(self.forms), len(self.previous_rules) + len(self.next_rules)))
+
+    def find(self, word, previous=None, following=None):
+        """Return the preferred lemma of `word` in the context of the words
+        `previous` and `following`, or None if it is not disambiguated.
+        """
+        if (previous, word) in self.previous_rules:
+            return self.previous_rules[(previous, word)]
+        if (word, following) in self.next_rules:
+            return self.next_rules[(word, following)]
+
+        return self.forms.get(word)
+
+
+class Stopwords(object):
+    """The lemmas to leave out of the index, one per line of a stopword
+    list.
+
+    A word is skipped when its only lemma is a stopword or, if `ambiguous`
+    is true, when all of its possible lemmas are. Since the lemma list
+    tells which forms that applies to, they can be recognized before the
+    lookup: `forms` maps each of them to its lemmas, and is filled from a
+    lookup engine by `find_forms`.
+    """
+
+    def __init__(self, text, ambiguous=False):
+        self.lemmas = set(word.strip() for word in text.split('\n'))
+        self.ambiguous = ambiguous
+        self.forms = None
+
+        log.debug('Loaded {} stopwords.'.format(len(self.lemmas)))
+
+    def skips(self, match_list):
+        """Return true if a word with the possible lemmas `match_list` is
+        skipped.
+        """
+        if len(match_list) == 1:
+            return match_list[0] in self.lemmas
+
+        return self.ambiguous and len(match_list) > 1 and self.lemmas.issuperset(match_list)
+
+    def find_forms(self, engine):
+        """Find the forms of the lemma list of `engine` that are skipped."""
+        self.forms = dict((form, lemmas) for form, lemmas
+                          in engine.forms_of(self.lemmas).items() if self.skips(lemmas))
+
+        log.debug('Found {} forms of the stopwords.'.format(len(self.forms)))
+
+
+def neighbours(words, position):
+    """Return the words before and after `position` in the list `words`.
+    None is returned for a missing neighbour at the start or end of it.
+    """
+    previous = words[position - 1] if position > 0 else None
+    following = words[position + 1] if position + 1 < len(words) else None
+
+    return(previous, following)
+
+
+def inform(message):
+    """Print a message for the user to stderr, unless the script runs
+    quietly. The results are written to stdout, so the messages are kept
+    out of them.
+    """
+    if not quiet:
+        sys.stderr.write(message + '\n')
+
+
+# Set by the --quiet option
+quiet = False
+
+
+class Progress(object):
+    """Progress bar showing how many of `total` words have been analyzed,
+    the speed and the estimated time left. Without a total (e.g. when
+    streaming), only the count and speed are shown.
+
+    The bar is redrawn at most every `interval` seconds, and the clock
+    is only checked every `every` words, so updating it costs next to
+    nothing. It is disabled when the script runs quietly or stdout is
+    not a terminal.
+    """
+
+    def __init__(self, total=None, interval=0.25, every=64, enabled=True):
+        self.total = total
+        self.interval = interval
+        self.every = every
+        self.enabled = (enabled and not quiet
+                        and getattr(stdout, 'isatty', lambda: False)())
+        self.started = time()
+        self.last_drawn = 0
+        self.next_check = every if self.enabled else float('inf')
+
+    def update(self, count, word=u''):
+        """Register that `count` words have been analyzed, the last one
+        being `word`, and redraw the bar if it is time to.
+        """
+        if count < self.next_check:
+            return
+        self.next_check = count + self.every
+
+        now = time()
+        if now - self.last_drawn >= self.interval:
+            self.last_drawn = now
+            self.draw(count, word, now - self.started)
+
+    def finish(self, count):
+        """Draw the bar a final time, for all `count` words."""
+        if self.enabled:
+            self.draw(count, u'', time() - self.started)
+            stdout.write('\n')
+            stdout.flush()
+
+    def draw(self, count, word, elapsed):
+        """Write the bar to stdout."""
+        speed = count / elapsed if elapsed else 0.0
+        line = u'Analyzing {0:29} '.format(word[:29])
+
+        if self.total:
+            fraction = min(1.0, count / float(self.total))
+            line += u'[{0:30}] {1:3.0f} %'.format(u'#' * int(round(fraction * 30)),
+                                                   fraction * 100)
+            left = (self.total - count) / speed if speed else 0
+            line += u' {0:5.0f} words/s {1} elapsed, {2} left'.format(
+                speed, self.format_time(elapsed), self.format_time(left))
+        else:
+            line += u'{0} words {1:5.0f} words/s {2} elapsed'.format(
+                count, speed, self.format_time(elapsed))
+
+        stdout.write((u'\r' + line + u'  ').encode('utf-8'))
+        stdout.flush()
+
+    def format_time(self, seconds):
+        """Format a number of seconds as minutes and seconds."""
+        return(u'{0:d}:{1:02d}'.format(*divmod(int(seconds), 60)))
+
+
+class Profile(object):
+    """Wall time spent in each stage of a run and counters of what the
+    analysis has done. The stages are timed in any case, since that is
+    cheap, but the counters and the time spent on lookups and
+    disambiguations word by word are only recorded when `enabled` is
+    true. Only the skipped stopwords are always counted, for the report
+    at the end of the run.
+    """
+
+    counter_names = ('tokens', 'lookups', 'hits', 'misses', 'ambiguous',
+                     'disambiguated', 'stopwords', 'stopwords before lookup',
+                     'guessed')
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = []
+        self.timings = {}
+        self.counters = dict.fromkeys(self.counter_names, 0)
+
+    def add_time(self, stage, seconds):
+        """Add `seconds` to the time spent in `stage`."""
+        if stage not in self.timings:
+            self.stages.append(stage)
+            self.timings[stage] = 0.0
+        self.timings[stage] += seconds
+
+    @contextmanager
+    def stage(self, stage):
+        """Context manager timing the code it wraps as part of `stage`."""
+        started = time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time() - started)
+
+    def merge(self, data):
+        """Add the timings and counters of `data`, as returned by `as_dict`
+        (e.g. by a worker process), to this profile.
+        """
+        for stage in data['stages']:
+            self.add_time(stage['stage'], stage['seconds'])
+        for name, value in data['counters'].items():
+            self.counters[name] += value
+
+    def as_dict(self):
+        """Return the timings and counters as a dictionary, for JSON."""
+        return({
+            'stages': [{'stage': stage, 'seconds': round(self.timings[stage], 6)}
+                       for stage in self.stages],
+            'counters': dict(self.counters),
+        })
+
+    def report(self):
+        """Return the timings and counters as a readable report."""
+        lines = ['Time spent per stage:']
+        for stage in self.stages:
+            lines.append('  {0:24} {1:10.3f} s'.format(stage, self.timings[stage]))
+        lines.append('Counters:')
+        for name in self.counter_names:
+            lines.append('  {0:24} {1:10d}'.format(name, self.counters[name]))
+        lines.append('Lookup and disambiguation are part of the analysis stage. '
+                     'With several jobs, they are summed over all processes.')
+
+        return('\n'.join(lines))
+
+
+# The analysis object shared with the worker processes of
+# `Analyze.run_parallel`.
+worker_analysis = None
+
+
+def run_chunk(chunk):
+    """Run an analysis method on a chunk of the text in a worker process.
+    `chunk` is a tuple of the method name and the start and end of the
+    chunk in the list of lines. Return the results along with the profile
+    of the worker.
+    """
+    method, start, end = chunk
+    lines = worker_analysis.text[start:end]
+    worker_analysis.profile = Profile(worker_analysis.profile.enabled)
+    results = getattr(worker_analysis, method)(lines, progress=False)
+
+    return(results, worker_analysis.profile.as_dict())
 
 
 class Analyze(object):
     """A class for all analysis of the text"""
 
-    def __init__(self, text, lemmas, disambiguations=False, stopwords=False):
+    def __init__(self, text, lemmas, disambiguations=False, stopwords=False,
+                 engine='index', batch=False, jobs=1, profile=None, fallback=False,
+                 stopword_stage='before', ambiguous_stopwords=False):
         self.text = text
         self.lemmas = lemmas
-        self.stopwords = [word.strip() for word in read_file(stopwords).split('\n')]
-        self.disambiguations = read_file(disambiguations).replace('\n', ' \n')
-        self.word_count = self.word_count(self.text)
+        self.engine = LOOKUP_ENGINES[engine](lemmas)
+        self.fallback = Fallback(self.engine) if fallback else None
+        self.stopwords = Stopwords(read_file(stopwords), ambiguous_stopwords)
+        self.stopword_stage = stopword_stage
+        self.disambiguations = Disambiguations(read_file(disambiguations))
+        self.word_count = self.count_words(self.text)
+        self.batch = batch
+        self.jobs = jobs
+        self.progress = None
+        self.profile = profile or Profile()
+        self.lookups = {}
 
         log.debug('Initialized an Analyze object')
 
-    def word_count(self, text):
+    def load_text(self, text):
+        """Replace the text to be analyzed, so the same object (and the
+        dictionary it has loaded) can be used for several texts.
+        """
+        self.text = text
+        self.word_count = self.count_words(text)
+        self.lookups = {}
+
+    def count_words(self, text):
         """Get wordcount from list of all words in text.
         Use itertools to flatten nested list of words in lines in line_list
 
@@ -223,21 +1922,108 @@ class Analyze(object):
 
         return(word_count)
 
-    def print_progress(self, word, iteration, word_count):
-        """Output the progress of the scrip to std.out.
-        """
-        increment = word_count / 30.0
-        percent = (float(iteration) / word_count) * 100
-        percent = round((iteration / float(word_count)) * 100.0, 0)
-        stdout.write(' ' * 80)
-        stdout.write('\r')
-        stdout.write('Analyzing {:29}'.format(
-            word.encode('utf-8') + ' '* (29 - len(word))))
-        stdout.write('[{}{}]'.format(
-            '#' * int(round(iteration / increment, 0)),
-            ' ' * int(round((word_count - iteration) / increment, 0))))
-        stdout.write(' {:2.0f} %\r'.format(percent))
-        stdout.flush()
+    def lookup(self, word, previous=None, following=None):
+        """Look up a single word in the lemma list and, if it is ambiguous,
+        in the disambiguations. `previous` and `following` are the words
+        before and after it on the line, used by context rules of the
+        disambiguations.
+
+        Return:
+        - list of possible lemmas of the word.
+        - the disambiguated lemma, or None if the word has not been
+          disambiguated.
+        """
+        if self.profile.enabled:
+            return self.profiled_lookup(word, previous, following)
+
+        if word in self.lookups:
+            match_list = self.lookups[word]
+        else:
+            match_list = self.engine.find(word)
+
+        lemma = None
+        if len(match_list) > 1:
+            lemma = self.disambiguations.find(word, previous, following)
+
+        return(match_list, lemma)
+
+    def profiled_lookup(self, word, previous=None, following=None):
+        """Version of `lookup` recording the time spent and the counters in
+        `self.profile`.
+        """
+        counters = self.profile.counters
+        counters['tokens'] += 1
+
+        started = time()
+        if word in self.lookups:
+            match_list = self.lookups[word]
+        else:
+            match_list = self.engine.find(word)
+            counters['lookups'] += 1
+        looked_up = time()
+        self.profile.add_time('lookup', looked_up - started)
+
+        lemma = None
+        if match_list:
+            counters['hits'] += 1
+        else:
+            counters['misses'] += 1
+        if len(match_list) > 1:
+            counters['ambiguous'] += 1
+            lemma = self.disambiguations.find(word, previous, following)
+            if lemma is not None:
+                counters['disambiguated'] += 1
+            self.profile.add_time('disambiguation', time() - looked_up)
+
+        return(match_list, lemma)
+
+    def guess(self, word):
+        """Return a list of guessed lemmas of a word that is not in the
+        lemma list, or an empty list when the fallback is not used.
+        """
+        if self.fallback is None:
+            return []
+
+        guesses = self.fallback.find(word)
+        if guesses and self.profile.enabled:
+            self.profile.counters['guessed'] += 1
+
+        return guesses
+
+    def stopword_forms(self):
+        """Return the forms of the stopwords that are skipped before the
+        lookup, or an empty dictionary if stopwords are only recognized
+        after it.
+        """
+        if self.stopword_stage != 'before':
+            return {}
+
+        if self.stopwords.forms is None:
+            with self.profile.stage('find stopword forms'):
+                self.stopwords.find_forms(self.engine)
+
+        return self.stopwords.forms
+
+    def lookup_types(self):
+        """Look up every distinct word of the text once, so the analysis of
+        each token can reuse the result instead of repeating the lookup.
+        """
+        tokens = [word.replace('.', '') for line in self.text
+                  for word in line[1].split(' ')]
+        types = set(tokens)
+
+        with self.profile.stage('lookup'):
+            self.lookups = dict((word, self.engine.find(word)) for word in types)
+        if self.profile.enabled:
+            self.profile.counters['lookups'] += len(types)
+
+        message = ('Batch lookup of {0} tokens: {1} distinct words (type/token '
+                   'ratio {2:.3f}), {3} lookups saved.'.format(
+                       len(tokens), len(types),
+                       len(types) / float(len(tokens) or 1),
+                       len(tokens) - len(types)))
+        log.info(message)
+        inform(message)
 
     def lemmatize_text(self):
         """Lemmatizes all words in text.
@@ -247,66 +2033,121 @@ class Analyze(object):
         Return:
         - nested list of results. Each sublist either contains 1, 2 or more items. 
         1 = no match, 2 = exact match, more = more possible matches.
+          Lemmas guessed by the fallback are Guess objects.
         """
 
         log.debug('Initializing lemmatization method...')
 
-        # Initiate vars: match_list and results
+        # Worker processes can't add to the cache of the main process, so
+        # fill it before the text is split among them
+        if self.batch or (self.jobs > 1 and isinstance(self.engine, LookupCache)):
+            self.lookup_types()
+
+        self.progress = Progress(self.word_count)
+
+        if self.jobs > 1:
+            results = []
+            for chunk_results in self.run_parallel('lemmatize_lines'):
+                results.extend(chunk_results)
+        else:
+            results = self.lemmatize_lines(self.text)
+
+        self.progress.finish(self.word_count)
+        self.progress = None
+
+        return(results)
+
+    def lemmatize_lines(self, lines, progress=True):
+        """Lemmatize all words in a list of numbered lines. See
+        `lemmatize_text` for the format of the results.
+        """
+        return(list(self.lemmatize_stream(lines, progress)))
+
+    def lemmatize_stream(self, lines, progress=False):
+        """Lemmatize all words in an iterable of numbered lines, e.g. from
+        `number_lines`, and yield the result of each word as soon as it is
+        ready. See `lemmatize_text` for the format of the results.
+
+        When `progress` is true, the progress is shown by `self.progress`,
+        or, if the stream is analyzed on its own, by a progress bar without
+        a total.
+        """
+        own_progress = progress and self.progress is None
+        if own_progress:
+            self.progress = Progress()
+
+        # Initiate vars: match_list
         match_list = []
-        results = []
 
         # Set the iteration for the progress bar
         iteration = 1
 
+        # Skip the formatting of debug messages when they are not logged
+        debug = log.isEnabledFor(logging.DEBUG)
+
+        if self.fallback is not None:
+            lines = join_hyphenated(lines)
+
         # Run each line and word of the text
-        for line in self.text:
-            log.debug('Start lemmatization of the line: ' + line[1].encode('utf-8'))
+        for line in lines:
+            if debug:
+                log.debug('Start lemmatization of the line: ' + line[1].encode('utf-8'))
 
-            for word in line[1].split(' '):
-                log.debug('Analyzing {0}'.format(word.encode('utf-8')))
+            # Remove dots, they confuse the parser
+            words = [word.replace('.', '') for word in line[1].split(' ')]
 
-                # Remove dots, they confuse the parser
-                word = word.replace('.', '')
+            for position, word in enumerate(words):
+                if debug:
+                    log.debug('Analyzing {0}'.format(word.encode('utf-8')))
 
                 # Enlighten the user
-                self.print_progress(word, iteration, self.word_count)
+                if progress:
+                    self.progress.update(iteration, word)
 
                 # Increase iteration for use in progress function
                 iteration += 1
 
                 # Put all possible lemmas of token in list
-                match_list = find_lemmas(word, self.lemmas)
-                log.debug('Matches for {0}: {1}'.format(
-                    word.encode('utf-8'),
-                    ' '.join(match_list).encode('utf-8')
-                ))
+                match_list, lemma = self.lookup(word, *neighbours(words, position))
+                if debug:
+                    log.debug('Matches for {0}: {1}'.format(
+                        word.encode('utf-8'),
+                        ' '.join(match_list).encode('utf-8')
+                    ))
 
-                # Put the results in a list. If there is no match, it only shows
+                # Yield the results as a list. If there is no match, it only shows
                 # the token form, if there is exactly one match, the token and
                 # the lemma are contained in the list, if there are more
                 # possible lemmas, it will look in the disambiguation list, and
                 # either return the disambiguated lemma or all possible lemmas.
                 if len(match_list) > 1:
-                    if word in self.disambiguations:
-                        lemma = find_lemmas(word, self.disambiguations)[0]
-                        log.debug('Word {} is disambiguated to {}'.format(
-                            word.encode('utf-8'),
-                            lemma.encode('utf-8')))
-                        results.append([word, lemma])
+                    if lemma is not None:
+                        if debug:
+                            log.debug('Word {} is disambiguated to {}'.format(
+                                word.encode('utf-8'),
+                                lemma.encode('utf-8')))
+                        yield [word, lemma]
                     else:
-                        results.append([word] + match_list)
+                        yield [word] + match_list
+
+                elif not match_list and self.fallback is not None:
+                    yield [word] + [Guess(guess) for guess in self.guess(word)]
 
                 else:
-                    results.append([word] + match_list)
+                    yield [word] + match_list
 
-        return(results)
+        if own_progress:
+            self.progress.finish(iteration - 1)
+            self.progress = None
 
-    def create_index(self):
-        """Lemmatizes all words in text.
+    def create_index(self, clean=True):
+        """Lemmatizes all words in text. If `clean` is false, the matched
+        terms are returned as a Postings object, without being counted and
+        formatted by `clean_matches`.
         Variables used:
         - self.text: the text to be analyzed, split into list of lines.
-        - self.lemmas: list of lemmas
-        - self.disambiguations: list of disambiguation terms
+        - self.engine: lookup engine of the lemma list
+        - self.disambiguations: table of disambiguations
 
         Return:
         - dictionary of sucessfully matched terms.
@@ -314,120 +2155,550 @@ class Analyze(object):
         - list of terms that could not be matched.
         """
 
-        def add_to_dict(key, value, dict):
-            """Add the word to the dictionary of matched. If there is no entry,
-            create it.
-            """
-            if key in dict.keys():
-                dict[key].append(value)
-            else:
-                dict[key] = [value]
-
         log.debug('Initializing lemmatization method...')
 
+        # Worker processes can't add to the cache of the main process, so
+        # fill it before the text is split among them
+        if self.batch or (self.jobs > 1 and isinstance(self.engine, LookupCache)):
+            self.lookup_types()
+
+        # Find the forms of the stopwords once, before the workers are forked
+        self.stopword_forms()
+
+        self.progress = Progress(self.word_count)
+
+        if self.jobs > 1:
+            # Join the results of the chunks in the order of the text, so the
+            # line references of each lemma end up in the same order as in
+            # a serial run.
+            match_dict = Postings()
+            nomatch_list = []
+            disamb_list = []
+            for chunk_matches, chunk_disamb, chunk_nomatch in self.run_parallel('index_lines'):
+                match_dict.extend(chunk_matches)
+                disamb_list.extend(chunk_disamb)
+                nomatch_list.extend(chunk_nomatch)
+        else:
+            match_dict, disamb_list, nomatch_list = self.index_lines(self.text)
+
+        self.progress.finish(self.word_count)
+        self.progress = None
+
+        if clean:
+            with self.profile.stage('clean matches'):
+                match_dict = clean_matches(match_dict)
+
+        return(match_dict, disamb_list, nomatch_list)
+
+    def index_external(self, lines, budget, chunk_size=1000):
+        """Index an iterable of numbered lines, e.g. from `number_lines`,
+        within a memory budget of about `budget` bytes. The lines are
+        analyzed in chunks of `chunk_size` lines, and the results are
+        collected in an ExternalIndex, which is returned.
+
+        Only the current chunk of the text is kept in memory, so the
+        analysis runs in this process, whatever `self.jobs` is.
+        """
+        index = ExternalIndex(self.engine, budget)
+        self.stopword_forms()
+        self.progress = Progress()
+
+        iteration = 0
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            # Keep words hyphenated across a line break in one chunk
+            if len(chunk) >= chunk_size and not (
+                    self.fallback is not None and line[1].rstrip().endswith('-')):
+                index.add(*self.index_lines(chunk, progress=False))
+                iteration += sum(len(line[1].split(' ')) for line in chunk)
+                self.progress.update(iteration)
+                chunk = []
+        index.add(*self.index_lines(chunk, progress=False))
+        iteration += sum(len(line[1].split(' ')) for line in chunk)
+
+        self.progress.finish(iteration)
+        self.progress = None
+
+        return(index)
+
+    def index_lines(self, lines, progress=True):
+        """Lemmatize all words in a list of numbered lines and sort them
+        for the index. See `create_index` for the format of the results, but
+        note that the matched terms are returned as a Postings object, not
+        yet counted and formatted by `clean_matches`.
+        """
+
         # First some variables
-        match_dict = {}
+        match_dict = Postings()
         nomatch_list = []
         disamb_list = []
 
         iteration = 1
 
+        # Skip the formatting of debug messages when they are not logged
+        debug = log.isEnabledFor(logging.DEBUG)
+
+        if self.fallback is not None:
+            lines = join_hyphenated(lines)
+
+        counters = self.profile.counters
+        stopword_forms = self.stopword_forms()
+
         # Run each line and word of the text
-        for line in self.text:
-            log.debug('Start lemmatization of the line: ' + line[1].encode('utf-8'))
+        for line in lines:
+            if debug:
+                log.debug('Start lemmatization of the line: ' + line[1].encode('utf-8'))
 
-            for word in line[1].split(' '):
-                log.debug('Analyzing {0}'.format(word.encode('utf-8')))
+            # Remove dots, they confuse the parser
+            words = [word.replace('.', '') for word in line[1].split(' ')]
 
-                # Remove dots, they confuse the parser
-                word = word.replace('.', '')
+            # Get the line number
+            line_number = line[0]
+            line_id = match_dict.line_id(line_number)
+
+            for position, word in enumerate(words):
+                if debug:
+                    log.debug('Analyzing {0}'.format(word.encode('utf-8')))
 
                 # Enlighten the user
-                self.print_progress(word, iteration, self.word_count)
+                if progress:
+                    self.progress.update(iteration, word)
 
                 # Increase iteration for use in progress function
                 iteration += 1
 
-                # Get the line number
-                line_number = str(line[0])
+                # Skip the known forms of stopwords without looking them up
+                if word in stopword_forms:
+                    counters['stopwords'] += 1
+                    counters['stopwords before lookup'] += 1
+                    if self.profile.enabled:
+                        counters['tokens'] += 1
+                    if debug:
+                        log.debug(
+                            'Skipping {0} on line {1}. Matches {2} in stopword list.'.format(
+                                word.encode('utf-8'),
+                                line_number,
+                                u', '.join(stopword_forms[word]).encode('utf-8'),
+                            )
+                        )
+                    continue
 
                 # Put all possible lemmas of token in list
-                match_list = find_lemmas(word, self.lemmas)
-
-                # If there is exactly one match, define the lemma and create
-                # an entry in the dictionary of matches
-                if len(match_list) == 1:
-                    lemma = match_list[0]
-                    log.debug('Single match in line {0}. Token: {1}; lemma: {2}.'.format(
-                        line_number,
-                        word.encode('utf-8'),
-                        lemma.encode('utf-8'),
-                    ))
-
-                    # Weed out stopwords (can only be done with nonambiguous terms).
-                    # TODO: Implement config to enable stopwords
-                    if lemma in self.stopwords:
-                        log.info(
+                match_list, disambiguated = self.lookup(word, *neighbours(words, position))
+
+                # Weed out the stopwords that were not recognized before the
+                # lookup
+                if self.stopwords.skips(match_list):
+                    counters['stopwords'] += 1
+                    if debug:
+                        log.debug(
                             'Skipping {0} on line {1}. Matches {2} in stopword list.'.format(
                                 word.encode('utf-8'),
                                 line_number,
-                                lemma.encode('utf-8'),
+                                u', '.join(match_list).encode('utf-8'),
                             )
                         )
-                        continue
+                    continue
+
+                # If there is exactly one match, define the lemma and create
+                # an entry in the dictionary of matches
+                if len(match_list) == 1:
+                    lemma = match_list[0]
+                    if debug:
+                        log.debug('Single match in line {0}. Token: {1}; lemma: {2}.'.format(
+                            line_number,
+                            word.encode('utf-8'),
+                            lemma.encode('utf-8'),
+                        ))
 
                 # Sort into the three output lists according to amount of suggestions.            
-                # No match
+                # No match. Guesses, if any, need disambiguation
                 if len(match_list) < 1:
-                    nomatch_list.append(
-                        [word, line[1]]
-                    )
+                    guesses = self.guess(word)
+                    if guesses:
+                        disamb_list.append([word, line[1], guesses])
+                    else:
+                        nomatch_list.append(
+                            [word, line[1]]
+                        )
 
                 # Matched > 1: Disambiguation needed
                 elif len(match_list) > 1:
 
-                    if word in self.disambiguations:
-                        lemma = find_lemmas(word, self.disambiguations)[0]
-                        log.debug('Word {} in disambiguation. Registering as {}'.format(
-                            word.encode('utf-8'),
-                            lemma.encode('utf-8')))
-                        add_to_dict(lemma, line_number, match_dict)
+                    if disambiguated is not None:
+                        lemma = disambiguated
+                        if debug:
+                            log.debug('Word {} in disambiguation. Registering as {}'.format(
+                                word.encode('utf-8'),
+                                lemma.encode('utf-8')))
+                        match_dict.add(lemma, line_id)
                     else:
                         disamb_list.append(
                             [word, line[1], [lemma.strip() for lemma in match_list]]
                         )
 
-                # Matched exactly one word. Add line to corresponding lemma
-                # list in the dictionary of matches
+                # Matched exactly one word. Add line to the occurrences of
+                # the lemma
                 else:
-                    if lemma in match_dict.keys():
-                        match_dict[lemma].append(line_number)
-                    else:
-                        match_dict[lemma] = [line_number]
-
-        match_dict = clean_matches(match_dict)
+                    match_dict.add(lemma, line_id)
 
         return(match_dict, disamb_list, nomatch_list)
 
+    def run_parallel(self, method):
+        """Split the text into chunks of lines and run `method` on each of
+        them in a pool of `self.jobs` worker processes.
+
+        The workers are forked from this process and inherit the analysis
+        object, including the loaded dictionary, so only the boundaries of
+        each chunk are sent to them. The results are yielded in the order
+        of the text.
+        """
+        from multiprocessing import Pool
+        global worker_analysis
+
+        chunk_count = max(1, min(len(self.text), self.jobs * 4))
+        chunk_size = max(1, (len(self.text) + chunk_count - 1) // chunk_count)
+        chunks = []
+        start = 0
+        while start < len(self.text):
+            end = min(start + chunk_size, len(self.text))
+            # Keep words hyphenated across a line break in one chunk
+            while (self.fallback is not None and end < len(self.text)
+                   and self.text[end - 1][1].rstrip().endswith('-')):
+                end += 1
+            chunks.append((method, start, end))
+            start = end
+        log.debug('Running {0} on {1} chunks in {2} processes.'.format(
+            method, len(chunks), self.jobs))
+
+        worker_analysis = self
+        pool = Pool(self.jobs)
+        try:
+            iteration = 0
+            for index, (results, profile) in enumerate(pool.imap(run_chunk, chunks)):
+                self.profile.merge(profile)
+                start, end = chunks[index][1:]
+                iteration += sum(len(line[1].split(' ')) for line in self.text[start:end])
+                self.progress.update(iteration)
+                yield results
+        finally:
+            pool.close()
+            pool.join()
+            worker_analysis = None
+
+
+def section_of(reference):
+    """Return the section of the line reference `reference`, i.e. the
+    reference without the line number, e.g. `323.d` of `323.d9`. Plain
+    line numbers are grouped in sections of 100 lines.
+    """
+    reference = str(reference)
+    prefix = reference.rstrip('0123456789')
+    if prefix or not reference:
+        return(prefix)
+
+    return(str((int(reference) - 1) // 100))
+
+
+def split_sections(lines, hyphenated=False):
+    """Split a list of numbered lines, as returned by
+    `add_line_numbers_to_lines`, into a list of sections of consecutive
+    lines with the same `section_of` their line reference.
+
+    With `hyphenated` true, a section is kept open while its last line
+    ends with `-`, so a word hyphenated across two sections is joined
+    within the first of them (see `join_hyphenated`).
+    """
+    sections = []
+    current = None
+    for line in lines:
+        section = section_of(line[0])
+        if section != current and not (
+                hyphenated and sections and sections[-1][-1][1].rstrip().endswith('-')):
+            sections.append([])
+            current = section
+        sections[-1].append(line)
+
+    return(sections)
+
+
+def section_hash(section):
+    """Return the SHA-1 hex digest of the line references and content of
+    the numbered lines in `section`.
+    """
+    digest = hashlib.sha1()
+    for reference, line in section:
+        digest.update(u'{0}\t{1}\n'.format(reference, line).encode('utf-8'))
+
+    return(digest.hexdigest())
+
+
+class IndexStore(object):
+    """SQLite database keeping the index of each input file, so it can be
+    queried and updated without analyzing the whole text again.
+
+    The files are split into sections by `split_sections`, and the
+    matched lemmas, ambiguous words and unknown words of each section are
+    stored along with a hash of its content. When a file is indexed
+    again, only the sections whose hash is not in the store are analyzed.
+    The store also keeps a fingerprint of the lemma, disambiguation and
+    stopword lists, and is emptied when they change.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS sections (
+            id INTEGER PRIMARY KEY, file INTEGER, position INTEGER, hash TEXT);
+        CREATE TABLE IF NOT EXISTS lemmas (id INTEGER PRIMARY KEY, lemma TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS postings (
+            section INTEGER, lemma INTEGER, line TEXT, count INTEGER);
+        CREATE TABLE IF NOT EXISTS ambiguities (
+            section INTEGER, word TEXT, line TEXT, suggestions TEXT);
+        CREATE TABLE IF NOT EXISTS unknown (section INTEGER, word TEXT, line TEXT);
+        CREATE INDEX IF NOT EXISTS sections_file ON sections (file, position);
+        CREATE INDEX IF NOT EXISTS postings_lemma ON postings (lemma);
+        CREATE INDEX IF NOT EXISTS postings_section ON postings (section);
+        CREATE INDEX IF NOT EXISTS ambiguities_section ON ambiguities (section);
+        CREATE INDEX IF NOT EXISTS unknown_section ON unknown (section);
+    """
+
+    def __init__(self, filename):
+        import sqlite3
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(self.schema)
+        log.debug('Opened the index store {}.'.format(filename))
+
+    def close(self):
+        self.connection.close()
+
+    def check_fingerprint(self, fingerprint):
+        """Empty the store if it was made with other lists than those with
+        the fingerprint `fingerprint`.
+        """
+        with self.connection:
+            row = self.connection.execute(
+                "SELECT value FROM settings WHERE key = 'fingerprint'").fetchone()
+            if row is not None and row[0] == fingerprint:
+                return
+            if row is not None:
+                inform('The lists have changed, indexing everything again.')
+            for table in ('files', 'sections', 'lemmas', 'postings', 'ambiguities', 'unknown'):
+                self.connection.execute('DELETE FROM {}'.format(table))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('fingerprint', ?)", (fingerprint,))
+
+    def file_id(self, name):
+        """Return the id of the file `name`, adding it if necessary."""
+        self.connection.execute('INSERT OR IGNORE INTO files (name) VALUES (?)', (name,))
+        return self.connection.execute(
+            'SELECT id FROM files WHERE name = ?', (name,)).fetchone()[0]
+
+    def lemma_id(self, lemma):
+        """Return the id of `lemma`, adding it if necessary."""
+        self.connection.execute('INSERT OR IGNORE INTO lemmas (lemma) VALUES (?)', (lemma,))
+        return self.connection.execute(
+            'SELECT id FROM lemmas WHERE lemma = ?', (lemma,)).fetchone()[0]
+
+    def update(self, name, lines, analysis):
+        """Index the numbered `lines` of the file `name` with the Analyze
+        object `analysis`, analyzing only the sections that have changed
+        since the file was last indexed. Return the results of the whole
+        file in the format of `Analyze.create_index` with `clean` false.
+        """
+        name = decode_filename(name)
+        sections = split_sections(lines, hyphenated=analysis.fallback is not None)
+
+        with self.connection:
+            file_id = self.file_id(name)
+
+            stored = {}
+            for section_id, digest in self.connection.execute(
+                    'SELECT id, hash FROM sections WHERE file = ?', (file_id,)):
+                stored.setdefault(digest, []).append(section_id)
+
+            analyzed = 0
+            for position, section in enumerate(sections):
+                digest = section_hash(section)
+                if stored.get(digest):
+                    section_id = stored[digest].pop()
+                    self.connection.execute(
+                        'UPDATE sections SET position = ? WHERE id = ?', (position, section_id))
+                else:
+                    self.add_section(file_id, position, digest, section, analysis)
+                    analyzed += 1
+
+            # Remove the sections that are no longer in the file
+            for section_ids in stored.values():
+                for section_id in section_ids:
+                    self.remove_section(section_id)
+
+        inform('Analyzed {0} of {1} sections of {2}.'.format(
+            analyzed, len(sections), name.encode('utf-8')))
+
+        return(self.results(file_id))
+
+    def add_section(self, file_id, position, digest, section, analysis):
+        """Analyze the numbered lines `section` and store the results."""
+        cursor = self.connection.execute(
+            'INSERT INTO sections (file, position, hash) VALUES (?, ?, ?)',
+            (file_id, position, digest))
+        section_id = cursor.lastrowid
+
+        matches, disamb_list, nomatch_list = analysis.index_lines(section, progress=False)
+        lemma_ids = [self.lemma_id(lemma) for lemma in matches.lemmas]
+        self.connection.executemany(
+            'INSERT INTO postings VALUES (?, ?, ?, ?)',
+            [(section_id, lemma_ids[lemma_id], u'{0}'.format(matches.lines[line_id]), count)
+             for lemma_id, (line_ids, counts) in enumerate(matches.postings)
+             for line_id, count in zip(line_ids, counts)])
+        self.connection.executemany(
+            'INSERT INTO ambiguities VALUES (?, ?, ?, ?)',
+            [(section_id, word, line, u' '.join(suggestions))
+             for word, line, suggestions in disamb_list])
+        self.connection.executemany(
+            'INSERT INTO unknown VALUES (?, ?, ?)',
+            [(section_id, word, line) for word, line in nomatch_list])
+
+    def remove_section(self, section_id):
+        """Remove a section and its results from the store."""
+        for table in ('postings', 'ambiguities', 'unknown'):
+            self.connection.execute(
+                'DELETE FROM {} WHERE section = ?'.format(table), (section_id,))
+        self.connection.execute('DELETE FROM sections WHERE id = ?', (section_id,))
+
+    def results(self, file_id):
+        """Return the stored results of a file in the format of
+        `Analyze.create_index` with `clean` false.
+        """
+        matches = Postings()
+        for lemma, line, count in self.connection.execute(
+                """SELECT lemmas.lemma, postings.line, postings.count
+                   FROM postings JOIN sections ON postings.section = sections.id
+                   JOIN lemmas ON postings.lemma = lemmas.id
+                   WHERE sections.file = ? ORDER BY sections.position, postings.rowid""",
+                (file_id,)):
+            matches.add(lemma, matches.line_id(line), count)
+
+        disamb_list = [
+            [word, line, suggestions.split(u' ')] for word, line, suggestions in
+            self.connection.execute(
+                """SELECT word, line, suggestions
+                   FROM ambiguities JOIN sections ON ambiguities.section = sections.id
+                   WHERE sections.file = ? ORDER BY sections.position, ambiguities.rowid""",
+                (file_id,))]
+        nomatch_list = [
+            [word, line] for word, line in
+            self.connection.execute(
+                """SELECT word, line
+                   FROM unknown JOIN sections ON unknown.section = sections.id
+                   WHERE sections.file = ? ORDER BY sections.position, unknown.rowid""",
+                (file_id,))]
+
+        return(matches, disamb_list, nomatch_list)
+
+    def work_names(self):
+        """Return a dictionary with the name of the work of each file in the
+        store (see `work_names`).
+        """
+        return(work_names([name for name, in self.connection.execute(
+            'SELECT name FROM files')]))
+
+    def find(self, lemmas):
+        """Return a Postings object with the occurrences of `lemmas` in all
+        files, where each line reference is prefixed by the name of the
+        work (see `work_names`).
+        """
+        names = self.work_names()
+        matches = Postings()
+        for lemma in lemmas:
+            for name, line, count in self.connection.execute(
+                    """SELECT files.name, postings.line, postings.count
+                       FROM postings JOIN lemmas ON postings.lemma = lemmas.id
+                       JOIN sections ON postings.section = sections.id
+                       JOIN files ON sections.file = files.id
+                       WHERE lemmas.lemma = ?
+                       ORDER BY files.name, sections.position, postings.rowid""",
+                    (lemma,)):
+                reference = u'{0} {1}'.format(names[name], line)
+                matches.add(lemma, matches.line_id(reference), count)
+
+        return(matches)
+
+    def ambiguities(self):
+        """Return a list of all unresolved ambiguous words, where each line
+        is prefixed by the name of the work.
+        """
+        names = self.work_names()
+        return([
+            [word, u'{0}: {1}'.format(names[name], line), suggestions.split(u' ')]
+            for name, word, line, suggestions in self.connection.execute(
+                """SELECT files.name, word, line, suggestions
+                   FROM ambiguities JOIN sections ON ambiguities.section = sections.id
+                   JOIN files ON sections.file = files.id
+                   ORDER BY files.name, sections.position, ambiguities.rowid""")])
+
+    def unknown(self):
+        """Return a list of all unknown words, where each line is prefixed
+        by the name of the work.
+        """
+        names = self.work_names()
+        return([
+            [word, u'{0}: {1}'.format(names[name], line)]
+            for name, word, line in self.connection.execute(
+                """SELECT files.name, word, line
+                   FROM unknown JOIN sections ON unknown.section = sections.id
+                   JOIN files ON sections.file = files.id
+                   ORDER BY files.name, sections.position, unknown.rowid""")])
+
 
 class Output(object):
-    """Output the input according to a given method."""
+    """Write the results to the shell, a file or both, in one of the
+    formats in `formats`.
 
-    def __init__(self, output=False):
+    The results are written piece by piece as they are formatted, instead
+    of being collected in one string first.
+    """
+
+    formats = ('markdown', 'jsonl', 'tsv')
+
+    def __init__(self, output=False, target='output.txt', format='markdown', engine=None):
         self.output = output
+        self.target = target
+        self.format = format
+        # The lookup engine provides the collation keys of its lemmas
+        self.engine = engine
+
+    @contextmanager
+    def open_targets(self, flush=False):
+        """Open the shell, the target file or both, according to the output
+        mode, and yield a function that writes a string to all of them.
+        With `flush`, each string is flushed as soon as it is written.
+        """
+        targets = []
+        if self.output in ('shell', 'both'):
+            targets.append(stdout)
+        if self.output in ('file', 'both'):
+            targets.append(open(self.target, 'w'))
+
+        def write(string):
+            for target in targets:
+                target.write(string)
+                if flush:
+                    target.flush()
 
-    def return_output(self, output_string):
-        """Return the output to stdout, file or both, according to optional arguments."""
+        try:
+            yield write
 
-        if self.output == 'shell':
-            print(output_string)
-        elif self.output == 'file':
-            with open('output.txt', 'w') as f:
-                f.write(output_string)
-        elif self.output == 'both':
-            print(output_string)
-            with open('output.txt', 'w') as f:
-                f.write(output_string)
+            # Markdown output to the shell has always ended with an empty line
+            if stdout in targets and self.format == 'markdown':
+                stdout.write('\n')
+        finally:
+            for target in targets:
+                if target is not stdout:
+                    target.close()
 
     def lvl1(self, title):
         """Format a level 2 markdown title and return it as string."""
@@ -446,69 +2717,430 @@ class Output(object):
         )
 
     def output_index(self, matches, disamb_list, nomatch_list, filename):
-        """Format the results of index method for printing, and return as
-        string.
-
+        """Write the results of the index method. `matches` maps each lemma
+        to a list of [line reference, count] pairs, as returned by
+        `count_matches`.
+        """
+        # Sort the terms alphabetically, by their collation keys
+        sort_key = collation_key if self.engine is None else self.engine.collation_key
+        terms = sorted(matches.keys(), key=sort_key)
+
+        self.stream_index(((term, matches[term]) for term in terms),
+                          disamb_list, nomatch_list, filename)
+
+    def stream_index(self, entries, disamb_list, nomatch_list, filename):
+        """Write an index whose terms come from the iterable `entries` of
+        (lemma, list of [line reference, count] pairs) tuples, in the order
+        of the index, e.g. from `ExternalIndex.matches`. `disamb_list` and
+        `nomatch_list` may be iterables as well.
+        """
+        # Ugly hack to solve strange occurence of empty terms
+        entries = ((term, references) for term, references in entries if term)
+
+        with self.open_targets() as write:
+            if self.format == 'jsonl':
+                self.index_jsonl(write, entries, disamb_list, nomatch_list)
+            elif self.format == 'tsv':
+                self.index_tsv(write, entries, disamb_list, nomatch_list)
+            else:
+                self.index_markdown(write, entries, disamb_list, nomatch_list, filename)
+
+    def index_markdown(self, write, entries, disamb_list, nomatch_list, filename):
+        """Write the index as markdown with `write`."""
+        write(self.lvl1('\nIndex of terms in {0}'.format(filename)))
+        write('Results generated on {0}\n'.format(strftime("%Y-%m-%d %H:%M:%S")))
+        write(self.lvl2('The following terms were found in the text:'))
+
+        for term, references in entries:
+            write('{0}: {1}'.format(
+                term.encode('utf-8'),
+                format_references(references).encode('utf-8')
+            ))
+        write('\n')
+
+        write(self.lvl2('The following terms need disambiguation:'))
+        self.ambiguities_markdown(write, disamb_list)
+
+        write(self.lvl2('The following terms could not be found:'))
+        self.unknown_markdown(write, nomatch_list)
+
+    def ambiguities_markdown(self, write, disamb_list):
+        """Write the words in need of disambiguation as markdown with
+        `write`.
         """
-        try:
-            from pyuca import Collator
-        except ImportError:
-            exit('Error: To output the index we need `pyuca` to sort the unicode '
-                 'text properly. Run `pip install pyuca` and try again.')
-
-        output = self.lvl1('\nIndex of terms in {0}'.format(filename))
-        output += 'Results generated on {0}\n'.format(strftime("%Y-%m-%d %H:%M:%S"))
-        output += self.lvl2('The following terms were found in the text:')
-
-        # sorted(matches.keys()) iterates the keys alphabetically. Uses
-        # pyuca to sort the Greek properly. See https://github.com/jtauber/pyuca
-        c = Collator()
-        for term in sorted(matches.keys(), key=c.sort_key):
-            if term:       # Ugly hack to solve strange occurence of empty terms
-                output += '{0}: {1}'.format(
-                    term.encode('utf-8'),
-                    matches[term].encode('utf-8')
-                )
-        output += '\n'
-
-        output += self.lvl2('The following terms need disambiguation:')
         for disamb_term in disamb_list:
-            output += '{0} in {1}\n'.format(
+            write('{0} in {1}\n'.format(
                 disamb_term[0].encode('utf-8'),
                 disamb_term[1].encode('utf-8')
-            )
-            output += 'Suggestions: {0}\n'.format(
+            ))
+            write('Suggestions: {0}\n'.format(
                 ", ".join([suggestion.encode('utf-8') for suggestion in disamb_term[2]])
-            )
+            ))
 
-        output += self.lvl2('The following terms could not be found:')
+    def unknown_markdown(self, write, nomatch_list):
+        """Write the words that could not be found as markdown with
+        `write`.
+        """
         for fail in nomatch_list:
-            output += '{0} in {1}\n'.format(
+            write('{0} in {1}\n'.format(
                 fail[0].encode('utf-8'),
                 fail[1].encode('utf-8')
-            )
+            ))
 
-        self.return_output(output)
+    def index_jsonl(self, write, entries, disamb_list, nomatch_list):
+        """Write the index as JSON Lines with `write`: One object for each
+        lemma, with its line references and their counts, followed by one
+        object for each word in need of disambiguation and each word that
+        could not be found, with the line it is on.
+        """
+        for term, references in entries:
+            self.write_json(write, {
+                'type': 'lemma',
+                'lemma': term,
+                'references': [{'line': line, 'count': count}
+                               for line, count in references],
+            })
+        for word, line, suggestions in disamb_list:
+            self.write_json(write, {
+                'type': 'ambiguous',
+                'word': word,
+                'line': line,
+                'suggestions': suggestions,
+            })
+        for word, line in nomatch_list:
+            self.write_json(write, {'type': 'unknown', 'word': word, 'line': line})
+
+    def index_tsv(self, write, entries, disamb_list, nomatch_list):
+        """Write the index as tab separated values with `write`. Each row
+        has the type of the entry (`lemma`, `ambiguous` or `unknown`), the
+        term, the line reference or line, the count of the reference and
+        the suggested lemmas, separated by spaces.
+        """
+        write('type\tterm\tline\tcount\tsuggestions\n')
+        for term, references in entries:
+            for line, count in references:
+                self.write_row(write, ['lemma', term, line, count, u''])
+        for word, line, suggestions in disamb_list:
+            self.write_row(write, ['ambiguous', word, line, u'', u' '.join(suggestions)])
+        for word, line in nomatch_list:
+            self.write_row(write, ['unknown', word, line, u'', u''])
+
+    def output_query(self, lemmas, matches, disamb_list, nomatch_list):
+        """Write the answer to a query of an index store: The occurrences
+        of `lemmas` in the Postings object `matches`, followed by the
+        ambiguous and unknown words in `disamb_list` and `nomatch_list`.
+        """
+        counted = matches.count()
+        entries = [(lemma, counted[lemma]) for lemma in lemmas if lemma in counted]
+
+        with self.open_targets() as write:
+            if self.format == 'jsonl':
+                self.index_jsonl(write, entries, disamb_list, nomatch_list)
+            elif self.format == 'tsv':
+                self.index_tsv(write, entries, disamb_list, nomatch_list)
+            else:
+                for lemma in lemmas:
+                    if lemma in counted:
+                        references = format_references(counted[lemma])
+                    else:
+                        references = u'not found'
+                    write(u'{0}: {1}\n'.format(lemma, references).encode('utf-8'))
+                self.ambiguities_markdown(write, disamb_list)
+                self.unknown_markdown(write, nomatch_list)
+
+    def output_lemmas(self, matches, filename, flush=False):
+        """Write the results of lemmatization, as they are produced by the
+        iterable `matches`. With `flush`, each result is flushed as soon as
+        it is written.
+        """
+        with self.open_targets(flush) as write:
+            if self.format == 'jsonl':
+                for match in matches:
+                    self.write_json(write, {
+                        'word': match[0],
+                        'lemmas': [item for item in match[1:] if not isinstance(item, Guess)],
+                        'guesses': [item for item in match[1:] if isinstance(item, Guess)],
+                    })
+            elif self.format == 'tsv':
+                write('word\tlemmas\tguesses\n')
+                for match in matches:
+                    self.write_row(write, [
+                        match[0],
+                        u' '.join(item for item in match[1:] if not isinstance(item, Guess)),
+                        u' '.join(item for item in match[1:] if isinstance(item, Guess)),
+                    ])
+            else:
+                write(self.lvl1('\nLemmas of terms in {0}'.format(filename)))
+                write('Results generated on {0}\n'.format(strftime("%Y-%m-%d %H:%M:%S")))
+                for match in matches:
+                    # Guesses are marked with a question mark
+                    write(' '.join(mark_guesses(match)).encode('utf-8') + '\n')
+
+    def stream_lemmas(self, matches, filename):
+        """Write the results of lemmatization one at a time, as they are
+        produced by the iterable `matches`.
+        """
+        self.output_lemmas(matches, filename, flush=True)
+
+    def write_json(self, write, record):
+        """Write the dictionary `record` as a line of JSON with `write`."""
+        import json
+        write(json.dumps(record, ensure_ascii=False, sort_keys=True).encode('utf-8') + '\n')
+
+    def write_row(self, write, values):
+        """Write the list `values` as a row of tab separated values with
+        `write`. Tabs and line breaks in the values are replaced by spaces.
+        """
+        values = [u'{0}'.format(value).replace(u'\t', u' ').replace(u'\n', u' ')
+                  for value in values]
+        write(u'\t'.join(values).encode('utf-8') + '\n')
 
-    def output_lemmas(self, matches, filename):
-        """Format the results of lemmatization for printing, and return as
-        string.
 
+class Prefetcher(object):
+    """Prepare the texts of `filenames` with `prepare` in a background
+    thread, while the texts before them are analyzed. At most `ahead`
+    prepared texts wait to be used, so memory stays bounded.
+
+    Iterating over the prefetcher yields the prepared texts in the order
+    of `filenames`. An error while preparing a text is raised when it
+    would have been yielded.
+    """
+
+    def __init__(self, filenames, prepare, ahead=2):
+        import threading
+        try:
+            from Queue import Queue
+        except ImportError:
+            from queue import Queue
+
+        self.filenames = filenames
+        self.prepare = prepare
+        self.queue = Queue(maxsize=ahead)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        for filename in self.filenames:
+            try:
+                self.queue.put((self.prepare(filename), None))
+            except Exception as error:
+                self.queue.put((None, error))
+                return
+
+    def __iter__(self):
+        for filename in self.filenames:
+            text, error = self.queue.get()
+            if error is not None:
+                raise error
+            yield text
+
+
+class BackgroundWriter(object):
+    """Run output functions in a background thread, in the order they are
+    submitted, so writing the results of one text overlaps with the
+    analysis of the next. At most `pending` functions wait to be run;
+    `submit` blocks until there is room.
+    """
+
+    def __init__(self, pending=2):
+        import threading
+        try:
+            from Queue import Queue
+        except ImportError:
+            from queue import Queue
+
+        self.queue = Queue(maxsize=pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            function, args = task
+            if self.error is None:
+                try:
+                    function(*args)
+                except Exception as error:
+                    self.error = error
+
+    def submit(self, function, *args):
+        """Run `function` with `args` in the background."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((function, args))
+
+    def close(self):
+        """Wait until all submitted functions have run, and raise the
+        error of the first one that failed, if any.
         """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def parse_address(address):
+    """Split an address of the form `host:port` into a tuple of host and
+    port number.
+    """
+    host, port = address.rsplit(':', 1)
+
+    return((host or 'localhost', int(port)))
 
-        output = self.lvl1('\nLemmas of terms in {0}'.format(filename))
-        output += 'Results generated on {0}\n'.format(strftime("%Y-%m-%d %H:%M:%S"))
 
-        for match in matches:
-            output += ' '.join(match).encode('utf-8') + '\n'
+def analyze_request(analysis, command, lines, scheme=StephanusReference,
+                    punctuation=PUNCTUATION):
+    """Lemmatize or index the list of raw lines `lines` with a copy of the
+    Analyze object `analysis` and return the results as a dictionary. The
+    lines are numbered in the citation scheme `scheme`, and the characters
+    in `punctuation` are removed from them.
 
-        self.return_output(output)
+    The copy shares the dictionary, stopwords and disambiguations of the
+    original, but has its own text, so several requests can be analyzed
+    at the same time.
+    """
+    from copy import copy
+
+    lines = [normalize_greek_accents(normalize('NFC', line), punctuation) for line in lines]
+    request_analysis = copy(analysis)
+    request_analysis.load_text(add_line_numbers_to_lines(lines, scheme) if lines else [])
+
+    if command == 'lemmatize':
+        results = request_analysis.lemmatize_lines(request_analysis.text, progress=False)
+        return({'results': [mark_guesses(match) for match in results]})
+    elif command == 'index':
+        match_dict, disamb_list, nomatch_list = request_analysis.index_lines(
+            request_analysis.text, progress=False)
+        return({
+            'matches': count_matches(match_dict),
+            'disambiguations': disamb_list,
+            'nomatches': nomatch_list,
+        })
+
+    raise ValueError('Unknown command: {}'.format(command))
+
+
+def serve(analysis, address, scheme=StephanusReference, punctuation=PUNCTUATION):
+    """Serve lemmatizations and indices of texts over HTTP with the Analyze
+    object `analysis`, which keeps the dictionary loaded between
+    requests. Each request is handled in its own thread.
+
+    Requests are posted as JSON to `/lemmatize` or `/index`, in the form
+    `{"lines": [...]}`, where the lines may contain line markers in the
+    citation scheme `scheme` (see `number_lines`). The characters in
+    `punctuation` are removed from the lines before the analysis. The
+    response contains the results of `Analyze.lemmatize_text`, with the
+    guessed lemmas marked by `mark_guesses`, or `Analyze.create_index` as
+    JSON, with the line references of the index counted by
+    `count_matches`. `/health` returns the status and
+    statistics of the server.
+    """
+    import json
+    import threading
+    try:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+
+    stats = {'requests': 0, 'lines': 0, 'words': 0, 'errors': 0}
+    stats_lock = threading.Lock()
+    started = time()
+
+    class RequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_json(404, {'error': 'Not found'})
+
+            with stats_lock:
+                content = dict(stats)
+            content.update(status='ok', uptime=round(time() - started, 3))
+            self.send_json(200, content)
+
+        def do_POST(self):
+            command = self.path.strip('/')
+            if command not in ('lemmatize', 'index'):
+                return self.send_json(404, {'error': 'Not found'})
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                lines = json.loads(self.rfile.read(length).decode('utf-8'))['lines']
+                if not isinstance(lines, list) or \
+                        not all(isinstance(line, string_types) for line in lines):
+                    raise ValueError('"lines" must be a list of strings')
+                results = analyze_request(analysis, command, lines, scheme, punctuation)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                with stats_lock:
+                    stats['errors'] += 1
+                return self.send_json(400, {'error': 'Bad request: {}'.format(e)})
+
+            with stats_lock:
+                stats['requests'] += 1
+                stats['lines'] += len(lines)
+                stats['words'] += sum(len(line.split(' ')) for line in lines)
+            self.send_json(200, results)
+
+        def log_message(self, format, *args):
+            log.info('Request from {0}: {1}'.format(self.client_address[0], format % args))
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(parse_address(address), RequestHandler)
+    inform('Serving on {}, press Ctrl-C to stop.'.format(address))
+    log.info('Serving on {}.'.format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def request_server(address, command, lines):
+    """Send the list of lines `lines` to the server at `address` (see
+    `serve`) to be lemmatized or indexed according to `command`, and
+    return the decoded response.
+    """
+    import json
+    try:
+        from urllib2 import urlopen, Request
+    except ImportError:
+        from urllib.request import urlopen, Request
+
+    host, port = parse_address(address)
+    request = Request(
+        'http://{0}:{1}/{2}'.format(host, port, command),
+        json.dumps({'lines': lines}).encode('utf-8'),
+        {'Content-Type': 'application/json'})
+    response = urlopen(request)
+    try:
+        return(json.loads(response.read().decode('utf-8')))
+    finally:
+        response.close()
 
 
 if __name__ == "__main__":
 
+    from docopt import docopt
+
     # Read command line arguments
-    args = docopt(__doc__, version='0.0.9')
+    args = docopt(__doc__, version=__version__)
 
     # Setup logging
     loglevel = args['--log']
@@ -518,41 +3150,292 @@ if __name__ == "__main__":
         level=getattr(logging, loglevel.upper()),
         format='%(levelname)s: %(message)s'
     )
-    log = logging
     log.info('App and logging initiated.')
 
-    # Map command line arguments to script and filename vars
-    filename = args['FILE']
-
-    # Open and read the text
-    content = read_file(args['FILE'])
-
-    content = normalize_greek_accents(content)
-    log.debug('Normalized accents of the loaded text.')
-
-    content_list = content.split("\n")
-    log.debug('Text has been split into list of lines.')
-
-    print('Reading the dictionary, be right back ...')
-    lemmas = read_file(args['--lemmas'])
-    log.debug('Lemma list read into memory')
+    quiet = args['--quiet']
+
+    if args['--format'] not in Output.formats:
+        exit('Error: Unknown format `{0}`. Choose one of: {1}.'.format(
+            args['--format'], ', '.join(Output.formats)))
+
+    if args['--stopword-stage'] not in ('before', 'after'):
+        exit('Error: Unknown stopword stage `{0}`. Choose `before` or `after`.'.format(
+            args['--stopword-stage']))
+
+    if args['--citation'] not in CITATION_SCHEMES:
+        exit('Error: Unknown citation scheme `{0}`. Choose one of: {1}.'.format(
+            args['--citation'], ', '.join(sorted(CITATION_SCHEMES))))
+    scheme = CITATION_SCHEMES[args['--citation']]
+
+    if args['--engine'] not in LOOKUP_ENGINES:
+        exit('Error: Unknown engine `{0}`. Choose one of: {1}.'.format(
+            args['--engine'], ', '.join(sorted(LOOKUP_ENGINES))))
+
+    try:
+        jobs = int(args['--jobs'])
+        assert jobs > 0
+    except (ValueError, AssertionError):
+        exit('Error: The number of jobs must be a positive integer.')
+    try:
+        cache_size = int(args['--cache-size'])
+        assert cache_size > 0
+    except (ValueError, AssertionError):
+        exit('Error: The size of the cache must be a positive integer.')
+
+    try:
+        prefetch = int(args['--prefetch'])
+        assert prefetch >= 0
+    except (ValueError, AssertionError):
+        exit('Error: The number of files to prefetch must be a whole number.')
+
+    budget = None
+    if args['--memory']:
+        try:
+            budget = int(float(args['--memory']) * 1024 * 1024)
+            assert budget > 0
+        except (ValueError, AssertionError):
+            exit('Error: The memory budget must be a positive number of megabytes.')
+        if args['--merge'] or args['--store']:
+            exit('Error: An index with a memory budget can not be merged or stored.')
+
+    if jobs > 1 and not hasattr(os, 'fork'):
+        log.warning('Parallel processing needs os.fork, running in one process.')
+        jobs = 1
+
+    # Worker processes forked while a background thread holds a lock, e.g.
+    # the lock of the log handler, inherit it locked and may never finish
+    if jobs > 1 and prefetch:
+        log.warning('Prefetching is not used together with --jobs.')
+        prefetch = 0
+
+    punctuation = args['--punctuation']
+    if isinstance(punctuation, bytes):
+        punctuation = punctuation.decode('utf-8')
 
-    content_list = add_line_numbers_to_lines(content_list)
-    log.debug('Line numbers added to list of lines.')
+    # Map command line arguments to script and filename vars
+    if args['serve']:
+        command = 'serve'
+    elif args['query']:
+        command = 'query'
+    else:
+        command = args['<command>']
+
+    if command == 'query':
+        # `query LEMMA...` also matches the first usage pattern, giving the
+        # lemmas as files
+        if not args['--store'] or not os.path.exists(args['--store']):
+            exit('Error: Give an existing index store to query with `--store`.')
+        log.debug('Query mode selected.')
+        store = IndexStore(args['--store'])
+        query = [normalize('NFC', lemma.decode('utf-8')) for lemma in args['LEMMA'] + args['FILE']]
+        output = Output(args['--output'], format=args['--format'])
+        output.output_query(query, store.find(query),
+                            store.ambiguities() if args['--ambiguous'] else [],
+                            store.unknown() if args['--unknown'] else [])
+        exit()
+
+    filenames = expand_filenames(args['FILE'])
+    if not filenames and command != 'serve':
+        exit('Error: No input files found.')
+    try:
+        names = work_names(filenames)
+    except ValueError as e:
+        exit('Error: {}'.format(e))
+
+    if command == 'compile':
+        log.debug('Compile mode selected.')
+        for filename in filenames:
+            target = filename + DICTIONARY_SUFFIX
+            compile_dictionary(filename, target)
+            inform('Compiled dictionary saved as {}.'.format(target))
+        exit()
+
+    if command == 'client':
+        log.debug('Client mode selected.')
+        for filename in filenames:
+            lines = read_file(filename).split('\n')
+            if len(filenames) > 1:
+                output = Output(args['--output'], output_filename(names[filename]),
+                                args['--format'])
+            else:
+                output = Output(args['--output'], format=args['--format'])
 
-    # Initialize the objects for analysis and output
-    analysis = Analyze( content_list, lemmas,
-                        disambiguations=args['--disambiguations'],
-                        stopwords=args['--stopwords'] )
-    output = Output(args['--output'])
-                                                                                                            
-    if args['<command>'] == 'index':
-        log.debug('Index mode selected.')
-        matches, disamb_list, nomatch_list = analysis.create_index()
-        output.output_index(matches, disamb_list, nomatch_list, filename)
-    elif args['<command>'] == 'lemmatize':
-        log.debug('Lemmatization mode selected.')
-        match_list = analysis.lemmatize_text()
-        output.output_lemmas(match_list, filename)
+            if args['--request'] == 'index':
+                response = request_server(args['--server'], 'index', lines)
+                output.output_index(response['matches'], response['disambiguations'],
+                                    response['nomatches'], filename)
+            else:
+                response = request_server(args['--server'], 'lemmatize', lines)
+                output.output_lemmas(
+                    [read_guesses(match) for match in response['results']], filename)
+        exit()
+
+    profile = Profile(enabled=bool(args['--profile']))
+
+    with profile.stage('load dictionary'):
+        lemmas = load_lemmas(args['--lemmas'], args['--engine'])
+
+    # Initialize the analysis object once for all input files
+    with profile.stage('load lists'):
+        analysis = Analyze( [], lemmas,
+                            disambiguations=args['--disambiguations'],
+                            stopwords=args['--stopwords'],
+                            engine=args['--engine'],
+                            batch=args['--batch'],
+                            jobs=jobs,
+                            profile=profile,
+                            fallback=args['--fallback'],
+                            stopword_stage=args['--stopword-stage'],
+                            ambiguous_stopwords=args['--ambiguous-stopwords'] )
+
+    if command == 'serve':
+        log.debug('Server mode selected.')
+        serve(analysis, args['--server'], scheme, punctuation)
+        exit()
+
+    cache = None
+    if args['--cache']:
+        with profile.stage('load cache'):
+            cache = LookupCache(args['--cache'], analysis.engine,
+                                lists_fingerprint([args['--lemmas'], args['--disambiguations']],
+                                                  u'{}'.format(args['--engine'])),
+                                cache_size)
+        analysis.engine = cache
+
+    store = None
+    if args['--store'] and command == 'index':
+        store = IndexStore(args['--store'])
+        # The results in the store depend on the lists and settings used
+        store.check_fingerprint(lists_fingerprint(
+            [args['--lemmas'], args['--disambiguations'], args['--stopwords']],
+            u'{0} {1} {2} {3} {4}'.format(args['--engine'], punctuation,
+                                          args['--ambiguous-stopwords'], args['--citation'],
+                                          args['--fallback'])))
+
+    # Read the next texts and write the results in the background, so the
+    # waiting for the disk overlaps with the analysis
+    texts = None
+    if prefetch and not (args['--stream'] and command == 'lemmatize') and not (
+            budget is not None and command == 'index'):
+        texts = iter(Prefetcher(
+            filenames, lambda filename: prepare_text(filename, punctuation, scheme=scheme),
+            prefetch))
+    writer = None
+    if prefetch and args['--output'] == 'file':
+        writer = BackgroundWriter(prefetch)
+        write_output = writer.submit
+    else:
+        write_output = lambda function, *args: function(*args)
+
+    merged_matches = Postings()
+    merged_disamb_list = []
+    merged_nomatch_list = []
+
+    for filename in filenames:
+        started = time()
+
+        # With several input files, each gets its own output file
+        if len(filenames) > 1:
+            output = Output(args['--output'], output_filename(names[filename]),
+                            args['--format'], analysis.engine)
+        else:
+            output = Output(args['--output'], format=args['--format'], engine=analysis.engine)
+
+        if args['--stream'] and command == 'lemmatize':
+            log.debug('Streaming lemmatization mode selected.')
+            lines = (normalize_greek_accents(line, punctuation) for line in read_lines(filename))
+            # Only show the progress if it doesn't mix with the results
+            results = analysis.lemmatize_stream(number_lines(lines, scheme),
+                                                progress=args['--output'] == 'file')
+            with profile.stage('streaming analysis and output'):
+                output.stream_lemmas(results, filename)
+            log.info('Lemmatized {0} in {1:.2f} seconds.'.format(filename, time() - started))
+            continue
+
+        if budget is not None and command == 'index':
+            log.debug('Index mode with a memory budget selected.')
+            lines = (normalize_greek_accents(line, punctuation) for line in read_lines(filename))
+            with profile.stage('analysis'):
+                index = analysis.index_external(number_lines(lines, scheme), budget)
+            with profile.stage('merge and output'):
+                output.stream_index(index.matches(), index.ambiguities(), index.unknown(),
+                                    filename)
+            log.info('Indexed {0} in {1:.2f} seconds.'.format(filename, time() - started))
+            continue
+
+        # Open and read the text, unless it has been prepared already
+        if texts is not None:
+            with profile.stage('wait for input'):
+                content_list = next(texts)
+        else:
+            content_list = prepare_text(filename, punctuation, profile, scheme)
+
+        analysis.load_text(content_list)
+
+        if command == 'index':
+            log.debug('Index mode selected.')
+            with profile.stage('analysis'):
+                if store is not None:
+                    name = filename if filename == '-' else os.path.abspath(filename)
+                    matches, disamb_list, nomatch_list = store.update(name, content_list,
+                                                                      analysis)
+                else:
+                    matches, disamb_list, nomatch_list = analysis.create_index(clean=False)
+            with profile.stage('clean matches'):
+                counted_matches = count_matches(matches)
+            with profile.stage('output'):
+                write_output(output.output_index, counted_matches, disamb_list,
+                             nomatch_list, filename)
+
+            if args['--merge']:
+                work = names[filename]
+                merged_matches.extend(matches, prefix=u'{0} '.format(work))
+                merged_disamb_list.extend(
+                    [word, u'{0}: {1}'.format(work, line), suggestions]
+                    for word, line, suggestions in disamb_list)
+                merged_nomatch_list.extend(
+                    [word, u'{0}: {1}'.format(work, line)] for word, line in nomatch_list)
+
+            log.info('Indexed {0} in {1:.2f} seconds.'.format(filename, time() - started))
+        elif command == 'lemmatize':
+            log.debug('Lemmatization mode selected.')
+            with profile.stage('analysis'):
+                match_list = analysis.lemmatize_text()
+            with profile.stage('output'):
+                write_output(output.output_lemmas, match_list, filename)
+            log.info('Lemmatized {0} in {1:.2f} seconds.'.format(filename, time() - started))
+
+    if args['--merge'] and command == 'index':
+        output = Output(args['--output'], 'output-merged.txt', args['--format'],
+                        analysis.engine)
+        with profile.stage('output'):
+            write_output(output.output_index, count_matches(merged_matches),
+                         merged_disamb_list, merged_nomatch_list, ', '.join(filenames))
+
+    if writer is not None:
+        with profile.stage('wait for output'):
+            writer.close()
+
+    if store is not None:
+        store.close()
+
+    if command == 'index' and profile.counters['stopwords']:
+        message = 'Skipped {0} stopwords, {1} of them without a lookup.'.format(
+            profile.counters['stopwords'], profile.counters['stopwords before lookup'])
+        log.info(message)
+        inform(message)
+
+    if cache is not None:
+        with profile.stage('save cache'):
+            message = cache.save()
+        log.info(message)
+        inform(message)
+        cache.close()
+
+    if args['--profile'] == 'json':
+        import json
+        sys.stderr.write(json.dumps(profile.as_dict(), indent=2) + '\n')
+    elif args['--profile']:
+        sys.stderr.write(profile.report() + '\n')
 
     log.info('Results returned sucessfully.')